@@ -0,0 +1,315 @@
+# Local stand-in for e621 API and static file server, with synthetic posts.
+# Knows just enough of e621 for e621dl:
+#   /posts.json          tags (id:<N, id:>N, id:A..B, id:1,2,3, date:>=, rating:,
+#                        -tag, ~tag, tag*), limit, page
+#   /posts/<id>.json
+#   /tags.json           search[name] (comma separated), search[name_matches]
+#   /tag_aliases.json    search[antecedent_name] (comma separated), search[name_matches]
+#   /data/<md5>.<ext>    file itself, with Range support
+#
+# python fake_e621.py --posts 10000 --port 8621
+
+# Internal Imports
+import argparse
+import hashlib
+import json
+import random
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+
+GENERAL_TAGS = 1000
+ARTIST_TAGS = 200
+SPECIES_TAGS = 50
+TAGS_PER_POST = 25
+ALIASES = 100
+
+class FakeE621:
+    def __init__(self, posts = 10000, days = 30, seed = 0,
+                 min_size = 20_000, max_size = 200_000, large_every = 0, large_size = 64*1024*1024):
+        rnd = random.Random(seed)
+        now = datetime.now(timezone.utc)
+
+        self.general = [f"tag{i}" for i in range(GENERAL_TAGS)]
+        self.artists = [f"artist{i}" for i in range(ARTIST_TAGS)]
+        self.species = [f"species{i}" for i in range(SPECIES_TAGS)]
+        # few tags are on most of posts, like on e621
+        weights = [1 / (rank + 1) for rank in range(GENERAL_TAGS)]
+
+        self.posts = []
+        for id in range(1, posts + 1):
+            created_at = now - timedelta(seconds = days * 86400 * (posts - id) / posts)
+            if large_every and id % large_every == 0:
+                size = large_size
+                ext = 'webm'
+            else:
+                size = rnd.randint(min_size, max_size)
+                ext = rnd.choice(['jpg', 'png', 'gif'])
+
+            general = sorted(set(rnd.choices(self.general, weights, k = TAGS_PER_POST)))
+            self.posts.append({
+                'id': id,
+                'created_at': created_at.isoformat(timespec = 'milliseconds'),
+                'file': {'width': 1000, 'height': 1000, 'ext': ext, 'size': size, 'md5': None, 'url': None},
+                'score': {'up': 0, 'down': 0, 'total': rnd.randint(-10, 200)},
+                'tags': {'general': general,
+                         'species': [rnd.choice(self.species)],
+                         'character': [], 'copyright': [],
+                         'artist': [rnd.choice(self.artists)],
+                         'invalid': [], 'lore': [], 'meta': []},
+                'rating': rnd.choice('sqe'),
+                'fav_count': rnd.randint(0, 500),
+                'sources': [],
+                'pools': [],
+                'description': '',
+                'uploader_id': 1,
+            })
+
+        self.ids = [post['id'] for post in self.posts]
+
+        self.post_counts = {}
+        for post in self.posts:
+            for taglist in post['tags'].values():
+                for tag in taglist:
+                    self.post_counts[tag] = self.post_counts.get(tag, 0) + 1
+
+        self.aliases = {f"alias{i}": f"tag{i}" for i in range(ALIASES)}
+
+        # md5 needs whole file, so it's counted when post is shown first time
+        self._md5_lock = Lock()
+        self._files = {}
+
+    @staticmethod
+    def content(id, size, start = 0, end = None):
+        # same bytes every time without storing them
+        block = hashlib.sha256(str(id).encode()).digest() * 2048
+        end = size if end is None else end
+        chunks = []
+        position = start
+        while position < end:
+            offset = position % len(block)
+            piece = block[offset:offset + end - position]
+            chunks.append(piece)
+            position += len(piece)
+        return b''.join(chunks)
+
+    def file_info(self, post, base_url):
+        file = post['file']
+        with self._md5_lock:
+            if file['md5'] is None:
+                hasher = hashlib.md5()
+                for start in range(0, file['size'], 1024*1024):
+                    hasher.update(self.content(post['id'], file['size'], start, min(start + 1024*1024, file['size'])))
+                file['md5'] = hasher.hexdigest()
+                self._files[f"{file['md5']}.{file['ext']}"] = post
+        return dict(post, file = dict(file, url = f"{base_url}/data/{file['md5']}.{file['ext']}"))
+
+    def search(self, tags, limit, page):
+        below, above, ids, earliest = None, None, None, None
+        rating = None
+        positive, negative, any_of = [], [], []
+        for tag in tags.split():
+            if tag.startswith('id:<'):
+                below = int(tag[4:])
+            elif tag.startswith('id:>'):
+                above = int(tag[4:])
+            elif tag.startswith('id:') and '..' in tag:
+                low, high = tag[3:].split('..')
+                above, below = int(low) - 1, int(high) + 1
+            elif tag.startswith('id:'):
+                ids = {int(id) for id in tag[3:].split(',')}
+            elif tag.startswith('date:>='):
+                earliest = tag[7:]
+            elif tag.startswith('rating:'):
+                rating = tag[7:8]
+            elif ':' in tag:
+                continue
+            elif tag[0] == '-':
+                negative.append(tag[1:])
+            elif tag[0] == '~':
+                any_of.append(tag[1:])
+            else:
+                positive.append(tag)
+
+        def has(post_tags, mask):
+            if '*' in mask:
+                return any(fnmatchcase(tag, mask) for tag in post_tags)
+            return mask in post_tags
+
+        # posts are sorted by id, newest are returned first
+        end = len(self.posts) if below is None else bisect_left(self.ids, below)
+        skip = (page - 1) * limit
+        result = []
+        for index in range(end - 1, -1, -1):
+            post = self.posts[index]
+            if above is not None and post['id'] <= above:
+                break
+            if earliest and post['created_at'][:10] < earliest:
+                break
+            if ids is not None and post['id'] not in ids:
+                continue
+            if rating and post['rating'] != rating:
+                continue
+            post_tags = {tag for taglist in post['tags'].values() for tag in taglist}
+            if not all(has(post_tags, tag) for tag in positive):
+                continue
+            if any(has(post_tags, tag) for tag in negative):
+                continue
+            if any_of and not any(has(post_tags, tag) for tag in any_of):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            result.append(post)
+            if len(result) >= limit:
+                break
+        return result
+
+    def tags(self, names = None, mask = None):
+        if names is not None:
+            found = [name for name in names if name in self.post_counts]
+        else:
+            found = [name for name in self.post_counts if fnmatchcase(name, mask)]
+        return [{'id': index, 'name': name, 'post_count': self.post_counts[name], 'category': 0}
+                for index, name in enumerate(found)]
+
+    def tag_aliases(self, names = None, mask = None):
+        if names is not None:
+            found = [name for name in names if name in self.aliases]
+        else:
+            found = [name for name in self.aliases if fnmatchcase(name, mask)]
+        return [{'id': index, 'antecedent_name': name, 'consequent_name': self.aliases[name], 'status': 'active'}
+                for index, name in enumerate(found)]
+
+    def file(self, name):
+        with self._md5_lock:
+            return self._files.get(name)
+
+def make_handler(fake, latency = 0.0):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def params(self):
+            # e621dl sends GET parameters as a form body
+            url = urlsplit(self.path)
+            params = parse_qs(url.query)
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                params.update(parse_qs(self.rfile.read(length).decode('utf-8')))
+            return url.path, {key: values[-1] for key, values in params.items()}
+
+        def send_json(self, data, status = 200):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def base_url(self):
+            return f"http://{self.headers.get('Host')}"
+
+        def do_GET(self):
+            path, params = self.params()
+            if latency:
+                sleep(latency)
+
+            if path == '/posts.json':
+                limit = int(params.get('limit', 75))
+                page = int(params.get('page', 1))
+                posts = fake.search(params.get('tags', ''), limit, page)
+                self.send_json({'posts': [fake.file_info(post, self.base_url()) for post in posts]})
+            elif path.startswith('/posts/') and path.endswith('.json'):
+                try:
+                    post = fake.posts[int(path[7:-5]) - 1]
+                except (ValueError, IndexError):
+                    self.send_json({'success': False}, 404)
+                else:
+                    self.send_json({'post': fake.file_info(post, self.base_url())})
+            elif path == '/tags.json':
+                if 'search[name]' in params:
+                    tags = fake.tags(names = params['search[name]'].split(','))
+                else:
+                    tags = fake.tags(mask = params.get('search[name_matches]', '*'))
+                self.send_json(tags or {'tags': []})
+            elif path == '/tag_aliases.json':
+                if 'search[antecedent_name]' in params:
+                    aliases = fake.tag_aliases(names = params['search[antecedent_name]'].split(','))
+                else:
+                    aliases = fake.tag_aliases(mask = params.get('search[name_matches]', '*'))
+                if int(params.get('page', 1)) > 1:
+                    aliases = []
+                self.send_json(aliases or {'tag_aliases': []})
+            elif path.startswith('/data/'):
+                self.send_file(path[6:])
+            else:
+                self.send_json({'success': False}, 404)
+
+        def send_file(self, name):
+            post = fake.file(name)
+            if post is None:
+                self.send_json({'success': False}, 404)
+                return
+
+            size = post['file']['size']
+            start, end = 0, size
+            range_header = self.headers.get('Range')
+            if range_header:
+                first, last = range_header[6:].split('-')
+                start = int(first)
+                end = min(size, int(last) + 1) if last else size
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f"bytes */{size}")
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f"bytes {start}-{end-1}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start))
+            self.end_headers()
+
+            for position in range(start, end, 1024*1024):
+                self.wfile.write(fake.content(post['id'], size, position, min(position + 1024*1024, end)))
+
+    return Handler
+
+def serve(fake, host = '127.0.0.1', port = 0, latency = 0.0):
+    server = ThreadingHTTPServer((host, port), make_handler(fake, latency))
+    server.daemon_threads = True
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description = "Local stand-in for e621 API")
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8621, help = "0 picks a free port")
+    parser.add_argument('--posts', type = int, default = 10000)
+    parser.add_argument('--days', type = int, default = 30)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--min-size', type = int, default = 20_000)
+    parser.add_argument('--max-size', type = int, default = 200_000)
+    parser.add_argument('--large-every', type = int, default = 0, help = "every Nth post is a big video")
+    parser.add_argument('--large-size', type = int, default = 64*1024*1024)
+    parser.add_argument('--latency', type = float, default = 0.0, help = "seconds added to every request")
+    args = parser.parse_args()
+
+    fake = FakeE621(args.posts, args.days, args.seed, args.min_size, args.max_size, args.large_every, args.large_size)
+    server = serve(fake, args.host, args.port, args.latency)
+    # runner reads port from here
+    print(f"listening on {server.server_address[1]}", flush = True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
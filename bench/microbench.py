@@ -0,0 +1,289 @@
+# Microbenchmarks of per-post CPU cost: parsing posts, filtering,
+# routing into subfolders and building file names. No network, no disk
+# besides empty folders from make_path in a temporary folder.
+#
+# python bench/microbench.py --posts 5000 --sections 100 --json before.json
+# python bench/microbench.py --posts 5000 --sections 100 --compare before.json
+
+# Internal Imports
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from statistics import median
+from time import perf_counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import e621dl
+from e621dl_lib import batch, constants, local, remote
+
+CATEGORIES = ('general', 'species', 'character', 'copyright', 'artist', 'invalid', 'lore', 'meta')
+GENERAL_TAGS = 5000
+FORMATS = ('{artist}', '{id}.{md5}', '{artist}_{score}_{rating}', '{created_at_string}_{artist}_{file_size}')
+
+def zipf_weights(count):
+    return [1 / (rank + 1) for rank in range(count)]
+
+def make_corpus(posts, seed = 0, days = 30):
+    # Decoded API json of posts. Number of general tags is lognormal,
+    # most posts have 20-50 tags and few have a couple hundred,
+    # and tag popularity is Zipf-like, as on e621.
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    general = [f"tag{i}" for i in range(GENERAL_TAGS)]
+    weights = zipf_weights(GENERAL_TAGS)
+    corpus = []
+    for id in range(1, posts + 1):
+        count = min(int(rnd.lognormvariate(3.4, 0.6)) + 1, 400)
+        tags = {category: [] for category in CATEGORIES}
+        tags['general'] = sorted(set(rnd.choices(general, weights, k = count)))
+        tags['species'] = [f"species{rnd.randrange(100)}" for dummy in range(rnd.randint(1, 3))]
+        tags['artist'] = [f"artist{rnd.randrange(2000)}"]
+        if rnd.random() < 0.3:
+            tags['character'] = [f"character{rnd.randrange(1000)}"]
+        if rnd.random() < 0.2:
+            tags['meta'] = ['hi_res']
+        created_at = now - timedelta(seconds = rnd.uniform(0, days * 86400))
+        corpus.append({
+            'id': id,
+            'created_at': created_at.isoformat(timespec = 'milliseconds'),
+            'file': {'width': 1000, 'height': 1000, 'ext': rnd.choice(['jpg', 'png', 'gif', 'webm']),
+                     'size': rnd.randint(20_000, 5_000_000), 'md5': f"{rnd.getrandbits(128):032x}",
+                     'url': f"https://static1.e621.net/data/{id}.jpg"},
+            'score': {'up': 0, 'down': 0, 'total': rnd.randint(-10, 300)},
+            'tags': tags,
+            'rating': rnd.choice('sqe'),
+            'fav_count': rnd.randint(0, 600),
+            'sources': [],
+            'pools': [rnd.randrange(1000)] if rnd.random() < 0.05 else [],
+            'description': 'description: : ? * <>' if rnd.random() < 0.1 else '',
+            'uploader_id': rnd.randrange(10000),
+        })
+    return corpus
+
+def make_search(directory, rnd, general, weights, blacklist):
+    # same keys process_config makes for a section
+    whitelist = [rnd.choices(general, weights)[0] for dummy in range(rnd.randint(0, 2))]
+    anylist = [f"species{rnd.randrange(100)}" for dummy in range(rnd.randint(0, 3))]
+    if rnd.random() < 0.2:
+        whitelist.append(f"{rnd.choice(general)[:4]}*")
+
+    cond_func = e621dl.default_condition
+    cond_source = None
+    if rnd.random() < 0.3:
+        first, second, third = rnd.choices(general, weights, k = 3)
+        source_template, tags = local.tags_and_source_template(f"({first} | {second}) & -{third}")
+        cond_func = local.make_check_funk(source_template, tags)
+        cond_source = (source_template, tuple(tags))
+
+    whitelist = local.TagMatcher(whitelist)
+    anylist = local.TagMatcher(anylist)
+    blacklist = local.TagMatcher(blacklist)
+    return {'directory': directory,
+            'search_tags': [],
+            'ratings': rnd.choice([['s'], ['s', 'q'], ['s', 'q', 'e']]),
+            'min_score': rnd.choice([-float('inf'), 0, 20]),
+            'min_favs': rnd.choice([0, 0, 10]),
+            'days_ago': 30,
+            'blacklist': blacklist,
+            'whitelist': whitelist,
+            'anylist': anylist,
+            'cond_func': cond_func,
+            'cond_source': cond_source,
+            'format': rnd.choice(FORMATS) if rnd.random() < 0.5 else '',
+            'subdirectories': set(),
+            'has_actual_search': e621dl.check_has_actual_search(whitelist, blacklist, anylist, cond_func),
+            'make_pooled_subfolder': False,
+            'move_pooled': False}
+
+def make_searches(sections, nesting = 2, children = 3, seed = 0):
+    # sections top level searches, each with a tree of nesting levels
+    # of up to children subfolders, like subfolders option makes
+    rnd = random.Random(seed)
+    general = [f"tag{i}" for i in range(GENERAL_TAGS)]
+    weights = zipf_weights(GENERAL_TAGS)
+    blacklist = [rnd.choice(general[100:]) for dummy in range(10)] + ['gore*']
+
+    searches = []
+    searches_dict = {}
+    for index in range(sections):
+        root = make_search(f"section{index}", rnd, general, weights, blacklist)
+        searches.append(root)
+        searches_dict[root['directory']] = root
+        level = [root]
+        for dummy in range(nesting):
+            next_level = []
+            for parent in level:
+                for child_index in range(rnd.randint(0, children)):
+                    child = make_search(f"{parent['directory']}_{child_index}", rnd, general, weights, blacklist)
+                    parent['subdirectories'].add(child['directory'])
+                    searches_dict[child['directory']] = child
+                    next_level.append(child)
+            level = next_level
+    return searches, searches_dict
+
+def fresh_posts(corpus):
+    # posts cache fields and tags, so every pass gets new ones
+    return remote.make_posts_list(corpus, [])
+
+def run_benchmarks(args):
+    corpus = make_corpus(args.posts, args.seed)
+    searches, searches_dict = make_searches(args.sections, args.nesting, args.children, args.seed)
+    pairs = args.posts * len(searches)
+    results = {}
+
+    def bench(name, function, items, prepare = None):
+        # prepare runs before every pass and is not timed,
+        # garbage collector is off while timed, like in timeit
+        timings = []
+        for dummy in range(args.repeats):
+            value = prepare() if prepare else None
+            gc.collect()
+            gc.disable()
+            try:
+                start = perf_counter()
+                function(value)
+                timings.append(perf_counter() - start)
+            finally:
+                gc.enable()
+        results[name] = {'items': items,
+                         'repeats': args.repeats,
+                         'best_ns': min(timings) / items * 1e9,
+                         'median_ns': median(timings) / items * 1e9}
+        if not args.quiet:
+            print(f"{name:32} {results[name]['best_ns']:12.1f} ns/item  ({items} items)", flush = True)
+
+    posts_list = lambda: fresh_posts(corpus)
+
+    bench('make_posts_list', lambda dummy: remote.make_posts_list(corpus, []), args.posts)
+
+    def post_fields(posts):
+        for post in posts:
+            post.tags, post.rating, post.score, post.fav_count, post.days_ago, post.file_ext
+    bench('post_fields', post_fields, args.posts, posts_list)
+
+    def post_tags(posts):
+        for post in posts:
+            post.post_tags()
+    bench('post_tags', post_tags, args.posts, posts_list)
+
+    def process_result(posts):
+        for post in posts:
+            for search in searches:
+                e621dl.process_result(post, **search)
+    bench('process_result', process_result, pairs, posts_list)
+
+    if batch.available():
+        # as download loop does it: every search and subfolder at once,
+        # one page of posts at a time
+        def classify(posts):
+            for index in range(0, len(posts), constants.MAX_RESULTS):
+                batch.classify(posts[index:index + constants.MAX_RESULTS], searches_dict.values())
+        bench('classify', classify, args.posts * len(searches_dict), posts_list)
+
+    conditions = [search['cond_func'] for search in searches_dict.values() if search['cond_source']]
+    if conditions:
+        def check_funk(posts):
+            for post in posts:
+                tags = post.post_tags().set
+                for cond_func in conditions:
+                    cond_func(tags)
+        bench('make_check_funk_condition', check_funk, args.posts * len(conditions), posts_list)
+
+    def get_directories(posts):
+        for post in posts:
+            for search in searches:
+                e621dl.get_directories(post, [search['directory']], search, searches_dict)
+    bench('get_directories', get_directories, pairs, posts_list)
+
+    def generate_format(posts):
+        for post in posts:
+            fields = post.generate()
+            for format in FORMATS:
+                format.format(**fields)[:100]
+    bench('generate_format', generate_format, args.posts, posts_list)
+
+    filenames = [f"{post['description'][:20]}{post['tags']['artist'][0]}_{post['id']}.{post['file']['ext']}" for post in corpus]
+    def substitute_illegals_filename(dummy):
+        for filename in filenames:
+            local.substitute_illegals_filename(filename)
+    bench('substitute_illegals_filename', substitute_illegals_filename, args.posts)
+
+    directories = list(searches_dict)
+    def make_path(dummy):
+        for index, filename in enumerate(filenames):
+            local.make_path(directories[index % len(directories)], filename)
+    bench('make_path', make_path, args.posts)
+
+    return {'searches': len(searches), 'folders': len(searches_dict), 'conditions': len(conditions)}, results
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = REPO_DIR,
+                              capture_output = True, text = True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline_file, threshold):
+    with open(baseline_file) as infile:
+        baseline = json.load(infile)['results']
+    regressions = []
+    print(f"\n{'':32} {'before':>12} {'after':>12} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['best_ns'], result['best_ns']
+        change = after / before - 1
+        mark = ' <-- slower' if change > threshold else ''
+        print(f"{name:32} {before:12.1f} {after:12.1f} {change:+8.1%}{mark}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = "e621dl per-post CPU cost microbenchmarks")
+    parser.add_argument('--posts', type = int, default = 5000)
+    parser.add_argument('--sections', type = int, default = 100, help = "top level sections, 10-500 is sensible")
+    parser.add_argument('--nesting', type = int, default = 2, help = "levels of subfolders under a section")
+    parser.add_argument('--children', type = int, default = 3, help = "up to this many subfolders per folder")
+    parser.add_argument('--repeats', type = int, default = 5)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--json', help = "write results to this file")
+    parser.add_argument('--compare', help = "results of an earlier run to compare with")
+    parser.add_argument('--threshold', type = float, default = 0.1, help = "slowdown counted as regression, 0.1 is 10%%")
+    parser.add_argument('--quiet', action = 'store_true')
+    args = parser.parse_args()
+    for name in ('json', 'compare'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    local.printer.show(False)
+    # make_path creates folders in downloads/
+    os.chdir(tempfile.mkdtemp(prefix = 'e621dl_microbench_'))
+    corpus_info, results = run_benchmarks(args)
+
+    report = {'revision': git_revision(),
+              'python': platform.python_version(),
+              'numpy': batch.available(),
+              'settings': vars(args),
+              'corpus': corpus_info,
+              'results': results}
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(report, outfile, indent = 2)
+
+    if args.compare:
+        if compare(results, args.compare, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# End-to-end benchmark: runs e621dl main() against bench/fake_e621.py
+# in a scratch folder and reports how fast posts and files went through.
+#
+# python bench/run_benchmark.py --posts 5000 --sections 10 --json result.json
+
+# Internal Imports
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+def start_server(args):
+    command = [sys.executable, os.path.join(BENCH_DIR, 'fake_e621.py'), '--port', '0',
+               '--posts', str(args.posts), '--days', str(args.days),
+               '--min-size', str(args.min_size), '--max-size', str(args.max_size),
+               '--large-every', str(args.large_every), '--large-size', str(args.large_size),
+               '--latency', str(args.latency)]
+    server = subprocess.Popen(command, stdout = subprocess.PIPE, text = True)
+    line = server.stdout.readline()
+    if not line.startswith('listening on '):
+        server.kill()
+        raise SystemExit(f"fake e621 did not start: {line!r}")
+    return server, int(line.split()[-1])
+
+def write_config(args):
+    # sections share the most common tags, so planner and filters have work to do
+    sections = []
+    for index in range(args.sections):
+        sections.append(f"""
+[section{index}]
+tags = tag{index % 5} tag{5 + index}
+days = {args.days}
+""")
+    os.makedirs('configs', exist_ok = True)
+    with open('configs/bench.ini', 'w') as config:
+        config.write(f"""[Settings]
+make_hardlinks = false
+api_rate = {args.api_rate}
+api_burst = {max(1, int(args.api_rate))}
+download_threads = {args.download_threads}
+
+[Defaults]
+days = {args.days}
+ratings = s q e
+""")
+        config.write(''.join(sections))
+
+def folder_stats(folder):
+    count = 0
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            count += 1
+            size += os.path.getsize(os.path.join(root, file))
+    return count, size
+
+def run(args):
+    server, port = start_server(args)
+    os.environ['E621DL_API_URL'] = f"http://127.0.0.1:{port}"
+    workdir = args.workdir or tempfile.mkdtemp(prefix = 'e621dl_bench_')
+    os.makedirs(workdir, exist_ok = True)
+    os.chdir(workdir)
+    write_config(args)
+
+    sys.path.insert(0, REPO_DIR)
+    sys.argv = ['e621dl.py'] + (['--metrics'] if args.metrics else [])
+    import e621dl
+    from e621dl_lib import local, remote
+
+    first_download = []
+    change_file = local.printer.change_file
+    def record_first_download(text):
+        if not first_download:
+            first_download.append(perf_counter())
+        change_file(text)
+    local.printer.change_file = record_first_download
+    local.printer.show(args.show)
+
+    try:
+        start = perf_counter()
+        e621dl.main()
+        elapsed = perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    files, size = folder_stats('downloads')
+    posts = local.printer.lines['posts so far']
+    result = {
+        'posts': posts,
+        'files': files,
+        'bytes': size,
+        'api_requests': remote.api_limiter.requests,
+        'seconds': elapsed,
+        'posts_per_second': posts / elapsed,
+        'files_per_second': files / elapsed,
+        'mb_per_second': size / elapsed / 1024 / 1024,
+        'time_to_first_download': first_download[0] - start if first_download else None,
+        'workdir': workdir,
+        'settings': vars(args),
+    }
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description = "e621dl end-to-end benchmark against local fake e621")
+    parser.add_argument('--posts', type = int, default = 5000)
+    parser.add_argument('--days', type = int, default = 30)
+    parser.add_argument('--sections', type = int, default = 10)
+    parser.add_argument('--min-size', type = int, default = 20_000)
+    parser.add_argument('--max-size', type = int, default = 200_000)
+    parser.add_argument('--large-every', type = int, default = 0)
+    parser.add_argument('--large-size', type = int, default = 64*1024*1024)
+    parser.add_argument('--latency', type = float, default = 0.0, help = "seconds added to every request")
+    parser.add_argument('--api-rate', type = float, default = 1000.0, help = "api_rate setting, real e621 needs 1")
+    parser.add_argument('--download-threads', default = '4')
+    parser.add_argument('--workdir', help = "folder to run in, temporary one by default")
+    parser.add_argument('--metrics', action = 'store_true', help = "let e621dl write metrics.json and metrics.prom to workdir")
+    parser.add_argument('--show', action = 'store_true', help = "show e621dl status screen")
+    parser.add_argument('--json', help = "write result to this file")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    result = run(args)
+    for key in ('posts', 'files', 'bytes', 'api_requests', 'seconds', 'posts_per_second',
+                'files_per_second', 'mb_per_second', 'time_to_first_download'):
+        value = result[key]
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(result, outfile, indent = 2)
+
+if __name__ == '__main__':
+    main()
@@ -30,28 +30,45 @@ del LINE_OF_INSTALL
 
 # Internal Imports
 import os
-import re
+import sys
+import hashlib
+from math import ceil, inf
+from time import sleep, monotonic
+from datetime import datetime, timedelta
 from distutils.version import StrictVersion
 from shutil import copy
 from threading import Thread
-from time import sleep
 from concurrent.futures import ThreadPoolExecutor
-from traceback import print_exc
+from collections import deque
+from queue import SimpleQueue, Empty
+from traceback import print_exc, format_exc
 
 # Personal Imports
 from e621dl_lib import constants
 from e621dl_lib import local
 from e621dl_lib import remote
+from e621dl_lib import batch
+from e621dl_lib.metrics import metrics
+from e621dl_lib.profiling import profiler
+from e621dl_lib.storage import writer
 
 # External Imports
 
+from natsort import natsorted
 from requests.exceptions import HTTPError
 
 download_queue = local.DownloadQueue()
 config_queue = local.ConfigQueue()
+watermarks = local.Watermarks()
 
 storage = local.PostsStorage()
-download_set = local.ActiveDownloadsSet()
+download_set = local.download_set
+
+# In daemon mode a failed config is retried on next poll instead of
+# stopping everything, so errors of API thread are kept here
+# and raised by process_config
+daemon_mode = False
+producer_errors = []
 
 def is_prefilter(section_name):
     return 'prefilter' == section_name or ( section_name[0]=='<' and section_name[-1] == '>' )
@@ -64,17 +81,17 @@ def check_has_actual_search(whitelist, blacklist, anylist, cond_func, **dummy):
     
 
 def process_result(post, whitelist, blacklist, anylist, cond_func, ratings, min_score, min_favs, days_ago, has_actual_search, **dummy):
-    tags = post.tags
-
     if not has_actual_search:
         return []
-    if whitelist and not all( any(reg.fullmatch(tag) for tag in tags) for reg in whitelist ):
+    
+    post_tags = post.post_tags()
+    if whitelist and not whitelist.all(post_tags):
         return []
-    elif blacklist and any( any(reg.fullmatch(tag) for tag in tags) for reg in blacklist ):
+    elif blacklist and blacklist.any(post_tags):
         return []
-    elif anylist and not any(any(reg.fullmatch(tag) for tag in tags) for reg in anylist):
+    elif anylist and not anylist.any(post_tags):
         return []
-    elif not cond_func(set(tags)):
+    elif not cond_func(post_tags.set):
         return []
     elif post.rating not in ratings:
         return []
@@ -89,6 +106,10 @@ def process_result(post, whitelist, blacklist, anylist, cond_func, ratings, min_
         
 
 def process_results(results, **dummy):
+    # big batches are filtered as numpy columns, if numpy is installed
+    if batch.available() and len(results) >= constants.BATCH_FILTER_MIN_POSTS:
+        return batch.filter_posts(results, **dummy)
+    
     filtered_results=[]
 
     for post in results:
@@ -96,6 +117,121 @@ def process_results(results, **dummy):
         
     return filtered_results
 
+# Query planner.
+# A search covers another one if every post from narrow search
+# is also returned by wide search within narrow search's days.
+# Then only wide search is requested from API, and its results are
+# filtered locally for every covered search, like [Prefilter] does.
+def split_search_tags(search_tags):
+    positive, negative, any_of, meta = set(), set(), set(), set()
+    for tag in search_tags:
+        if ':' in tag:
+            meta.add(tag)
+        elif tag[0] == '-':
+            negative.add(tag[1:])
+        elif tag[0] == '~':
+            any_of.add(tag[1:])
+        else:
+            positive.add(tag)
+    return positive, negative, any_of, meta
+
+def is_plannable(search):
+    return (search['gen_funcs'] == remote.get_posts
+            and search['has_actual_search']
+            and not any('order:' in tag for tag in search['search_tags']))
+
+def covers(wide, narrow):
+    if wide['days_ago'] < narrow['days_ago']:
+        return False
+    
+    w_positive, w_negative, w_any, w_meta = split_search_tags(wide['search_tags'])
+    n_positive, n_negative, n_any, n_meta = split_search_tags(narrow['search_tags'])
+    
+    # metatags are added to tags of every returned post,
+    # so only same metatags give same local filtering
+    if w_meta != n_meta:
+        return False
+    if not (w_positive <= n_positive and w_negative <= n_negative):
+        return False
+    if w_any and not ( (n_any and n_any <= w_any) or (n_positive & w_any) ):
+        return False
+    return True
+
+def query_only(search):
+    # Local filters that API knows nothing about are
+    # checked in download loop for every search separately
+    return dict(search,
+                ratings = ['s', 'q', 'e'],
+                min_score = -0x7F_FF_FF_FF,
+                min_favs = 0,
+                cond_func = default_condition,
+                cond_source = None)
+
+def plan_scans(searches):
+    plannable = [search for search in searches if is_plannable(search)]
+    
+    def is_root(search):
+        index = plannable.index(search)
+        for other_index, other in enumerate(plannable):
+            if other is search or not covers(other, search):
+                continue
+            # of two equal searches first one is a root
+            if not covers(search, other) or other_index < index:
+                return False
+        return True
+    
+    roots = [search for search in plannable if is_root(search)]
+    served = {id(root):[] for root in roots}
+    for search in plannable:
+        if search in roots:
+            continue
+        root = next(root for root in roots if covers(root, search))
+        served[id(root)].append(search)
+    
+    scans = []
+    scan_targets = {}
+    for search in searches:
+        if search not in plannable:
+            scans.append(search)
+            continue
+        elif id(search) not in served:
+            continue
+        elif not served[id(search)]:
+            scans.append(search)
+            continue
+        
+        scan = query_only(search)
+        scan['served_queries'] = [query_only(narrow) for narrow in served[id(search)]]
+        scans.append(scan)
+        scan_targets[search['directory']] = {search['directory']} | {narrow['directory'] for narrow in served[id(search)]}
+    
+    return scans, scan_targets
+
+# Incremental sync.
+# Every scan remembers the newest post it has seen, and next run
+# asks API only for newer ones. Key is the query, local filters, days
+# and post limit of every search fed by the scan, so changed section,
+# e.g. one with more days, is scanned fully again.
+# posts_countdown is still the configured limit when the key is made.
+WATERMARK_FIELDS = ('directory', 'search_tags', 'ratings', 'min_score', 'min_favs',
+                    'cond_source', 'format', 'subdirectories', 'make_pooled_subfolder', 'move_pooled',
+                    'days_ago', 'posts_countdown')
+
+def is_incremental(scan):
+    return (scan['gen_funcs'] == remote.get_posts
+            and not any('order:' in tag for tag in scan['search_tags']))
+
+def watermark_key(scan, targets):
+    filters = []
+    for search in sorted(targets, key=lambda search: search['directory']):
+        fields = [search[field] for field in WATERMARK_FIELDS]
+        fields += [sorted(search[field].masks) for field in ('whitelist', 'blacklist', 'anylist')]
+        fields[2] = sorted(fields[2]) # ratings
+        fields[7] = sorted(fields[7]) # subdirectories
+        filters.append(repr(fields))
+    digest = hashlib.md5('\n'.join(filters).encode('utf-8')).hexdigest()
+    return f"{' '.join(sorted(scan['search_tags']))}|{digest}"
+
 def get_pools(post):
     try:
         pools = post.pools
@@ -119,7 +255,8 @@ def process_results_pools(results, **dummy):
         
 
 #TODO: describe how this all works. God this is not intuitive
-def get_directories(post, root_dirs, search, searches_dict):
+# verdicts are optional results of batch.classify for the chunk of this post
+def get_directories(post, root_dirs, search, searches_dict, verdicts=None):
     subdirectories = search['subdirectories']
     
     # below lies recursion
@@ -127,7 +264,10 @@ def get_directories(post, root_dirs, search, searches_dict):
     # until we get to branch with no subbranches
     results = []
     
-    search_result = process_result(post, **search)
+    if verdicts is None:
+        search_result = process_result(post, **search)
+    else:
+        search_result = post.id in verdicts[search['directory']]
     
     # We travel below only if current folder matches
     # our criteria or there is nothing to look for
@@ -137,7 +277,7 @@ def get_directories(post, root_dirs, search, searches_dict):
             if directory in root_dirs:
                 continue
 
-            results += get_directories(post, root_dirs + [directory], searches_dict[directory], searches_dict)
+            results += get_directories(post, root_dirs + [directory], searches_dict[directory], searches_dict, verdicts)
     # And for each branch on the same level,
     # We check if we should place files there.
     # If we find matching folder on a deeper level
@@ -150,7 +290,9 @@ def get_directories(post, root_dirs, search, searches_dict):
     else:
         return results
 
-def get_files(post, filename, directories, files, session, cachefunc, duplicate_func, download_post, search, api_key, login):
+def get_files(post, filename, directories, files, session, cachefunc, duplicate_func, download_post, search, api_key, login, md5_mismatch):
+    # created are files that did not exist before, for local.FileIndex
+    created = []
     with download_set.context_id(post.id):
         for directory in directories:
             file_id=post.id
@@ -159,23 +301,149 @@ def get_files(post, filename, directories, files, session, cachefunc, duplicate_
                 local.printer.increment_old()
             elif file_id in files:
                 duplicate_func(files[file_id], path)
+                created.append(path)
                 local.printer.increment_copied()
             else:
-                if download_post(post.file_url, path, session, cachefunc, duplicate_func, api_key, login):
+                if download_post(post.file_url, path, session, cachefunc, duplicate_func, api_key, login,
+                                 md5 = post.md5, md5_mismatch = md5_mismatch, file_size = post.file_size):
                     files[file_id]=path
+                    created.append(path)
+                    if cachefunc:
+                        created.append(f"cache/{'.'.join(os.path.basename(path).split('.')[-2:])}")
                     local.printer.increment_downloaded()
                 else:
                     local.printer.increment_not_found()
-                    return search, False, directories, filename
+                    return search, False, directories, filename, created
         
-        return search, True, directories, filename
+        return search, True, directories, filename, created
                 
-#@profile
+class DownloadPipeline:
+    # Downloads from every chunk taken from download_queue go to workers
+    # as soon as the chunk is filtered, without waiting for previous chunks.
+    # Workers only report completion through self._completed: countdowns
+    # and PathesStorage are updated by the thread that owns them.
+    # Chunks leave download_queue in order and only when all their downloads
+    # are done, so the saved queue still has everything that is in flight.
+    # Posts over max_downloads are kept in their chunk while any download
+    # is in flight, a failed one may free a place for them.
+    def __init__(self, submit_func, pathes_storage, pools_folders):
+        self._submit = submit_func
+        self._pathes_storage = pathes_storage
+        self._pools_folders = pools_folders
+        self._completed = SimpleQueue()
+        self._chunks = deque()
+        self._futures = set()
+        self._pending = 0
+    
+    def __len__(self):
+        return len(self._chunks)
+    
+    def add_chunk(self, results_pair):
+        chunk_state = {'pending': 0, 'deferred': []}
+        self._chunks.append(chunk_state)
+        
+        self._pathes_storage.begin()
+        self._submit_pairs(chunk_state, results_pair)
+        self._pathes_storage.commit()
+        self._pop_finished_chunks()
+    
+    def _submit_pairs(self, chunk_state, results_pair):
+        for search, post, verdicts in results_pair:
+            # Posts over limit wait until we know if
+            # all submitted downloads were successful
+            if search['posts_countdown'] <= 0:
+                chunk_state['deferred'].append( (search, post, verdicts) )
+                continue
+            
+            future = self._submit(search, post, verdicts)
+            if future is None:
+                continue
+            
+            search['posts_countdown'] -= 1
+            chunk_state['pending'] += 1
+            self._pending += 1
+            self._futures.add(future)
+            future.add_done_callback(lambda future, chunk_state=chunk_state: self._done(chunk_state, future))
+    
+    def _done(self, chunk_state, future):
+        # in worker thread; wakes download loop if it waits for the next chunk
+        self._futures.discard(future)
+        self._completed.put((chunk_state, future))
+        download_queue.wake()
+    
+    def cancel(self):
+        # downloads that have not started yet
+        for future in list(self._futures):
+            future.cancel()
+    
+    def has_completed(self):
+        return not self._completed.empty()
+    
+    def process_completed(self, timeout = None):
+        try:
+            if timeout:
+                item = self._completed.get(timeout=timeout)
+            else:
+                item = self._completed.get_nowait()
+        except Empty:
+            return
+        
+        self._pathes_storage.begin()
+        failed = False
+        while item:
+            chunk_state, future = item
+            if future.exception():
+                raise future.exception()
+            
+            #Recovering wrong countdown decrement
+            #Still not good and may lead to less post than
+            #max_posts. But better than it was
+            search, success, directories, filename, created = future.result()
+            if not success:
+                search['posts_countdown'] += 1
+                failed = True
+            else:
+                self._pathes_storage.add_all_time_downloaded(directories, filename)
+            self._pathes_storage.add_files(created)
+            
+            chunk_state['pending'] -= 1
+            self._pending -= 1
+            
+            try:
+                item = self._completed.get_nowait()
+            except Empty:
+                item = None
+        
+        if failed:
+            # oldest chunks first, posts still over limit are deferred again
+            for chunk_state in self._chunks:
+                if chunk_state['deferred']:
+                    deferred = chunk_state['deferred']
+                    chunk_state['deferred'] = []
+                    self._submit_pairs(chunk_state, deferred)
+        self._pathes_storage.commit()
+        self._pop_finished_chunks()
+    
+    def _is_finished(self, chunk_state):
+        return chunk_state['pending'] == 0 and (not chunk_state['deferred'] or self._pending == 0)
+    
+    def _pop_finished_chunks(self):
+        if self._chunks and self._is_finished(self._chunks[0]):
+            # chunk leaves the saved queue only when its files are in files.db
+            self._pathes_storage.sync()
+        while self._chunks and self._is_finished(self._chunks[0]):
+            self._chunks.popleft()
+            download_queue.popleft()
+            local.save_pools(self._pools_folders)
+            download_queue.save()
+
 def prefilter_build_index(kwargses, use_db, searches):
     
     if use_db:
         storage.connect()
-        max_queue_len=1
+        # db chunks are huge, but download loop still needs
+        # the next one while previous is downloading
+        max_queue_len=2
     else:
         max_queue_len=10
     
@@ -195,26 +463,49 @@ def prefilter_build_index(kwargses, use_db, searches):
             append_func=kwargs['append_func']
             max_days_ago=kwargs['days_ago']
             
+            served_queries = kwargs.get('served_queries', [])
+            served_counts = [0] * len(served_queries)
+            
+            top_id = 0
+            # posts below the place where max_downloads stopped the scan
+            # were never looked at, so it gets no watermark
+            stopped_by_limit = False
             for results in gen(last_id, **kwargs):
+                top_id = max(top_id, max(post.id for post in results))
                 local.printer.increment_posts(len(results))
                 append_func(results)
+                for i, query in enumerate(served_queries):
+                    with metrics.timer('filter_seconds', section=query['directory']):
+                        served_counts[i] += len(process_results(results, **query))
                 filtered_results=[post for post in results if post.id not in blocked_ids]
                 process_results_pools(filtered_results)  # adding tag pool:<pool id> for every pools for a post
-                filtered_results=process_results(filtered_results, **kwargs)
+                with metrics.timer('filter_seconds', section=directory):
+                    filtered_results=process_results(filtered_results, **kwargs)
                 local.printer.increment_filtered(len(set(results) - set(filtered_results)))
                 
-                download_queue.append( (directory, filtered_results), max_queue_len )
                 post=results[-1]
-                download_queue.last_id=post.id
+                if not download_queue.append( (directory, filtered_results), max_queue_len, last_id=post.id ):
+                    # closed by download loop after an error
+                    return
                 if post.days_ago >= max_days_ago:
                     break
                 
                 if not any(s for s in searches if s['posts_countdown'] > 0):
+                    stopped_by_limit = True
                     break
             last_id = None
             download_queue.completed_gen(directory)
+            if kwargs.get('watermark_key') and top_id and not stopped_by_limit:
+                watermarks.set_pending(kwargs['watermark_key'], top_id)
+            
+            # each covered search would have needed at least one request
+            if served_queries:
+                local.printer.increment_pages_saved(sum(max(1, ceil(count / constants.MAX_RESULTS)) for count in served_counts))
         download_queue.completed = True
     except HTTPError as e:
+        if daemon_mode:
+            producer_errors.append(e)
+            return
         local.printer.show(False)
         local.printer.stop()
         local.printer.join()
@@ -223,7 +514,10 @@ def prefilter_build_index(kwargses, use_db, searches):
         print_exc()
         print("Http Status: ", e.response.status_code)
         print("Text: ", e.response.text)
-    except:
+    except Exception as e:
+        if daemon_mode:
+            producer_errors.append(e)
+            return
         local.printer.show(False)
         local.printer.stop()
         local.printer.join()
@@ -231,55 +525,296 @@ def prefilter_build_index(kwargses, use_db, searches):
         print("Exception in api iterator:")
         print_exc()
     finally:
-        download_queue.aborted = True
+        download_queue.close()
         if use_db:
             storage.close()
           
 def global_config_options(configs):
-    for configname in configs:
-        config, hash = local.get_config(configname)
-        
+    # Settings here are shared by all configs: flags are on if any config
+    # turns them on, thread counts take the biggest value,
+    # tag_cache_days, metrics_interval, api_rate and api_burst the smallest one
     prune_downloads = False
     prune_cache = False
     no_redownload = False
     full_offlines = []
     need_to_check_pools_config = False
-    for section in config.sections():
-        # Get values from the "Settings" section. Currently only used for file name appending.
-        
-        if section.lower() == 'settings':
-            current_full_offline = False
-            for option, value in config.items(section):
-                if option.lower() in {'prune_downloads'}:
-                    if value.lower() == 'true':
-                        prune_downloads = True
-                elif option.lower() in {'prune_cache'}:
-                    if value.lower() == 'true':
-                        prune_cache = True
-                elif option.lower() in {'no_redownload', 'bOnlyProcessDownloaded', 'forbid_redownload'}:
-                    if value.lower() == 'true':
-                        no_redownload = True
-                if option.lower() in {'full_offline', 'offline'}:
-                    if value.lower() == 'true':
-                        current_full_offline = True
-                if option.lower() in {'pool_download_generate'}:
-                    if value.lower() == 'true':
-                        need_to_check_pools_config = True
-            full_offlines.append(current_full_offline)
+    download_threads = None
+    adaptive_download_threads = False
+    max_download_threads = None
+    tag_cache_days = None
+    refresh_tag_cache = False
+    enable_metrics = False
+    metrics_interval = None
+    enable_profiler = False
+    profile_memory = False
+    api_rate = None
+    api_burst = None
+    for configname in configs:
+        config, hash = local.get_config(configname)
+        for section in config.sections():
+            if section.lower() == 'settings':
+                current_full_offline = False
+                for option, value in config.items(section):
+                    if option.lower() in {'prune_downloads'}:
+                        if value.lower() == 'true':
+                            prune_downloads = True
+                    elif option.lower() in {'prune_cache'}:
+                        if value.lower() == 'true':
+                            prune_cache = True
+                    elif option.lower() in {'no_redownload', 'bOnlyProcessDownloaded', 'forbid_redownload'}:
+                        if value.lower() == 'true':
+                            no_redownload = True
+                    if option.lower() in {'full_offline', 'offline'}:
+                        if value.lower() == 'true':
+                            current_full_offline = True
+                    if option.lower() in {'pool_download_generate'}:
+                        if value.lower() == 'true':
+                            need_to_check_pools_config = True
+                    if option.lower() in {'download_threads', 'downloads', 'max_workers'}:
+                        if value.lower() in {'auto', 'adaptive'}:
+                            adaptive_download_threads = True
+                        else:
+                            download_threads = max(download_threads or 0, int(value))
+                    if option.lower() in {'max_download_threads'}:
+                        max_download_threads = max(max_download_threads or 0, int(value))
+                    if option.lower() in {'tag_cache_days', 'tag_cache_ttl'}:
+                        tag_cache_days = min(tag_cache_days if tag_cache_days is not None else float('inf'), float(value))
+                    if option.lower() in {'refresh_tag_cache'}:
+                        if value.lower() == 'true':
+                            refresh_tag_cache = True
+                    if option.lower() in {'metrics'}:
+                        if value.lower() == 'true':
+                            enable_metrics = True
+                    if option.lower() in {'metrics_interval'}:
+                        metrics_interval = min(metrics_interval if metrics_interval is not None else float('inf'), float(value))
+                    if option.lower() in {'profile', 'profiling'}:
+                        if value.lower() == 'true':
+                            enable_profiler = True
+                    if option.lower() in {'profile_memory'}:
+                        if value.lower() == 'true':
+                            profile_memory = True
+                    if option.lower() in {'api_rate', 'requests_per_second'}:
+                        try:
+                            rate = float(value)
+                        except ValueError:
+                            rate = 0
+                        if rate > 0:
+                            api_rate = min(api_rate if api_rate is not None else float('inf'), rate)
+                        else:
+                            local.printer.change_warning(f"[!] incorrect api_rate in {configname}: {value}, must be a positive number")
+                    if option.lower() in {'api_burst', 'requests_burst'}:
+                        try:
+                            burst = int(value)
+                        except ValueError:
+                            burst = 0
+                        if burst > 0:
+                            api_burst = min(api_burst if api_burst is not None else float('inf'), burst)
+                        else:
+                            local.printer.change_warning(f"[!] incorrect api_burst in {configname}: {value}, must be a positive whole number")
+                full_offlines.append(current_full_offline)
     
     if not full_offlines:
         full_offline = False
     else:
         full_offline = min(full_offlines)
+    
+    if download_threads is None:
+        download_threads = constants.DOWNLOAD_THREADS
+    if max_download_threads is None:
+        max_download_threads = constants.MAX_DOWNLOAD_THREADS
+    if tag_cache_days is None:
+        tag_cache_days = constants.TAG_CACHE_DAYS
+    if metrics_interval is None:
+        metrics_interval = constants.METRICS_INTERVAL
+    if api_rate is None:
+        api_rate = constants.API_RATE_LIMIT
+    if api_burst is None:
+        api_burst = constants.API_BURST
+    
+    download_set.configure(download_threads, adaptive_download_threads, max_download_threads)
+    local.tag_cache.configure(tag_cache_days, refresh_tag_cache or '--refresh-tags' in sys.argv)
+    metrics.configure(enable_metrics or '--metrics' in sys.argv, metrics_interval)
+    metrics.start()
+    # before tag aliases are prefetched, it's the first thing sent to API
+    remote.api_limiter.configure(rate = api_rate, burst = api_burst)
+    profiler.configure(enable_profiler or '--profile' in sys.argv, profile_memory or '--profile-memory' in sys.argv)
     return prune_downloads, prune_cache, no_redownload, full_offline, need_to_check_pools_config
         
+def collect_config_tags(configs):
+    # {(api_key, login): tags} of every option that process_config
+    # checks with get_tag_alias, so they can be checked all at once
+    tags_by_user = {}
+    for configname in configs:
+        config, hash = local.get_config(configname)
+        
+        api_key = None
+        login = None
+        full_offline = False
+        tags = set()
+        for section in config.sections():
+            section_id = section.lower().strip()
+            for option, value in config.items(section):
+                op_low = option.lower()
+                if section_id == 'settings':
+                    if op_low in {'password', 'api_key', 'key'}:
+                        api_key = value.strip()
+                    elif op_low in {'login', 'username', 'name'}:
+                        login = value.strip().lower()
+                    elif op_low in {'full_offline', 'offline'} and value.lower() == 'true':
+                        full_offline = True
+                elif section_id == 'defaults':
+                    continue
+                elif section_id == 'blacklist':
+                    if op_low in {'tags', 'tag'}:
+                        tags.update(value.replace(',', ' ').lower().strip().split())
+                elif op_low in {'tags', 'tag', 'blacklist', 'blacklist_tags', 'blacklisted'}:
+                    tags.update(value.replace(',', ' ').lower().strip().split())
+                elif op_low in {'condition', 'conditions'} and value.lower().strip():
+                    tags.update(local.tags_and_source_template(value.lower().strip())[1])
+        
+        if not full_offline:
+            tags_by_user.setdefault((api_key, login), set()).update(tags)
+    return tags_by_user
+
+def import_tag_exports():
+    # e621dl --import-tags tags-2020-01-01.csv tag_aliases-2020-01-01.csv
+    if '--import-tags' not in sys.argv:
+        return False
+    
+    filenames = []
+    for filename in sys.argv[sys.argv.index('--import-tags')+1:]:
+        if filename.startswith('--'):
+            break
+        filenames.append(filename)
+    
+    # Antecedents of aliases are in tags export too,
+    # so aliases go last or they are overwritten by plain tags
+    for filename in sorted(filenames, key=local.TagCache.is_alias_export):
+        print(f"Importing {filename}")
+        print(f"{local.tag_cache.import_csv(filename)} entries imported")
+    return True
+
+def poll_intervals(filename):
+    # {section directory: seconds between scans} for daemon mode
+    config, hash = local.get_config(filename)
+    
+    default_interval = constants.POLL_INTERVAL
+    for section in config.sections():
+        if section.lower().strip() == 'defaults':
+            for option, value in config.items(section):
+                if option.lower() in {'poll_interval', 'poll_minutes'}:
+                    default_interval = float(value) * 60
+    
+    intervals = {}
+    for section in config.sections():
+        section_id = section.lower().strip()
+        if section_id in {'settings','defaults','blacklist'} or is_prefilter(section_id):
+            continue
+        
+        section_directory = section_id[1:] if section_id[0] == "*" else section_id
+        intervals[section_directory] = default_interval
+        for option, value in config.items(section):
+            if option.lower() in {'poll_interval', 'poll_minutes'}:
+                intervals[section_directory] = float(value) * 60
+    return hash, intervals
+
+def log_daemon_error(what, e):
+    local.printer.change_warning(f"{what} failed, retrying on next poll: {e!r}")
+    with open(constants.DAEMON_ERROR_LOG, 'a', encoding='utf-8') as log:
+        log.write(f"{datetime.now():%Y-%m-%d %H:%M:%S} {what}\n{format_exc()}\n")
+
+def run_daemon(session, pathes_storage, cookies, pools):
+    # Session, file index, tag aliases and databases stay open between polls.
+    # Every section is scanned again when its poll_interval has passed,
+    # all sections of a config are due right away when the config is changed.
+    global daemon_mode
+    daemon_mode = True
+    watermarks.enabled = True
+    last_polls = {}
+    hashes = {}
+    while True:
+        # failed sections are retried after CONFIG_CHECK_INTERVAL
+        failed = set()
+        configs = natsorted(local.get_configs())
+        schedule = {}
+        changed = []
+        for config in configs:
+            hash, intervals = poll_intervals(config)
+            if hashes.get(config) != hash:
+                changed.append(config)
+                for key in [key for key in last_polls if key[0] == config]:
+                    del last_polls[key]
+            hashes[config] = hash
+            schedule[config] = intervals
+        
+        if changed:
+            global_config_options(configs)
+            local.printer.change_status("Checking tags")
+            try:
+                for (api_key, login), tags in collect_config_tags(changed).items():
+                    remote.prefetch_tag_aliases(tags, api_key, login, session)
+            except Exception as e:
+                log_daemon_error("tag check", e)
+        
+        files = None
+        for config, intervals in schedule.items():
+            now = monotonic()
+            due = {directory for directory, interval in intervals.items()
+                   if now - last_polls.get( (config, directory), -inf ) >= interval}
+            if not due:
+                continue
+            
+            try:
+                # folders could be changed while we were sleeping
+                if files is None:
+                    local.printer.change_status("Updating downloaded files dict")
+                    files = local.get_files_dict(False, False)
+                    all_time_downloaded = local.get_all_time_downloaded()
+                
+                process_config(config, session, pathes_storage, files, all_time_downloaded, cookies, pools, due_sections = due)
+            except Exception as e:
+                log_daemon_error(config, e)
+                failed.update( (config, directory) for directory in due )
+                continue
+            for directory in due:
+                last_polls[ (config, directory) ] = monotonic()
+        
+        if files is not None and pools:
+            try:
+                local.generate_pools_config(pools)
+                process_config('configs/pools.generated', session, pathes_storage, files, all_time_downloaded, cookies, pools)
+            except Exception as e:
+                log_daemon_error('configs/pools.generated', e)
+        
+        next_poll = monotonic() + constants.CONFIG_CHECK_INTERVAL
+        for config, intervals in schedule.items():
+            for directory, interval in intervals.items():
+                if (config, directory) in failed:
+                    continue
+                next_poll = min(next_poll, last_polls.get( (config, directory), -inf ) + interval)
+        
+        wait = max(0, next_poll - monotonic())
+        local.printer.change_status(f"Waiting for next poll at {datetime.now() + timedelta(seconds = wait):%H:%M:%S}")
+        sleep(wait)
+
+def save_on_exit():
+    writer.close()
+    download_queue.save()
+    metrics.stop()
+
 def main():
+    args = [arg.strip().lower() for arg in sys.argv]
+    if import_tag_exports():
+        writer.close()
+        return
     # local.printer.show(False)
     local.printer.start()
-    local.save_on_exit_events(download_queue.save)
+    local.save_on_exit_events(save_on_exit)
     current_configs = local.get_configs()
     
     prune_downloads, prune_cache, no_redownload, dummy_full_offline, need_to_check_pools_config = global_config_options(current_configs)
+    # pruning needs every post of every section seen again
+    watermarks.enabled = not prune_downloads
     
     if need_to_check_pools_config:
         local.make_pools_config()
@@ -293,7 +828,7 @@ def main():
     pools = local.load_pools()
     
     local.printer.change_status("Building downloaded files dict")
-    files = local.get_files_dict(config_queue.reset_filedb, not no_redownload)
+    files = local.get_files_dict(config_queue.reset_filedb, not no_redownload, rebuild_index = '--rebuild-file-index' in args)
     all_time_downloaded = local.get_all_time_downloaded()
     pathes_storage=local.PathesStorage()
     config_queue.reset_filedb = False
@@ -301,7 +836,14 @@ def main():
     
     cookies = local.get_cookies()
     
-    with remote.requests_retry_session() as session:
+    with remote.requests_retry_session(pool_maxsize = download_set.max_threads) as session:
+        local.printer.change_status("Checking tags")
+        prepare_session(session, cookies)
+        if '--daemon' in args:
+            run_daemon(session, pathes_storage, cookies, pools)
+        
+        for (api_key, login), tags in collect_config_tags(config_queue.get_remaining()).items():
+            remote.prefetch_tag_aliases(tags, api_key, login, session)
 
         for config in config_queue.get_remaining():
             process_config(config, session, pathes_storage, files, all_time_downloaded, cookies, pools)
@@ -334,25 +876,28 @@ def main():
     
     
 
-# TODO: separate config to a class and convert 
-def process_config(filename, session, pathes_storage, files, all_time_downloaded, cookies, pools_folders):
-    # Create the requests session that will be used throughout the run.
-
-    config_name = '/'.join(filename.replace('\\','/').split('/')[1:])
-    local.printer.change_config(config_name)    
-
+def prepare_session(session, cookies):
     session.headers['accept-encoding'] = "gzip, deflate, br"
 
     if cookies:
         session.headers['cookie'] = cookies
     # Set the user-agent. Requirements are specified at https://e621.net/help/show/api#basics.
     session.headers['user-agent'] = f"e621dl (lurkbbs) -- Version {constants.VERSION}"
+
+# TODO: separate config to a class and convert 
+def process_config(filename, session, pathes_storage, files, all_time_downloaded, cookies, pools_folders, due_sections = None):
+    # Create the requests session that will be used throughout the run.
+
+    config_name = '/'.join(filename.replace('\\','/').split('/')[1:])
+    local.printer.change_config(config_name)    
+
+    prepare_session(session, cookies)
     
     local.printer.change_status("Parsing config")
 
     config, hash = local.get_config(filename)
     download_queue.check_config_hash(hash)
-    download_queue.aborted = False
+    download_queue.reopen()
 
     # Initialize the lists that will be used to filter posts.
     blacklist = []
@@ -391,6 +936,8 @@ def process_config(filename, session, pathes_storage, files, all_time_downloaded
     prune_cache = False
     api_key = None
     login = None
+    md5_mismatch = constants.MD5_MISMATCH
+    incremental_sync = True
     
     pool_download_generate = False
     
@@ -429,6 +976,13 @@ def process_config(filename, session, pathes_storage, files, all_time_downloaded
                 elif option.lower() in {'pool_download_generate'}:
                     if value.lower() == 'true':
                         pool_download_generate = True
+                elif option.lower() in {'md5_mismatch', 'on_md5_mismatch'}:
+                    if value.lower().strip() in {'retry', 'quarantine', 'keep'}:
+                        md5_mismatch = value.lower().strip()
+                    else:
+                        local.printer.change_warning(f"incorrect md5_mismatch: {value.lower()}, fallback to default: {md5_mismatch}")
+                elif option.lower() in {'incremental_sync', 'incremental'}:
+                    incremental_sync = value.lower() == 'true'
                 
         if section.lower() == 'settings':
             for option, value in config.items(section):
@@ -438,7 +992,7 @@ def process_config(filename, session, pathes_storage, files, all_time_downloaded
                         default_append_func = lambda x: None
                         
                         get_tag_alias = lambda _tag, _api_key, _login, _session: _tag
-                        download_post = lambda _file_url, _path, _session, _cachefunc, _duplicate_func, _api_key, _login : False
+                        download_post = lambda _file_url, _path, _session, _cachefunc, _duplicate_func, _api_key, _login, **_kwargs : False
                         
                         use_db = True
                         allow_append = False
@@ -547,6 +1101,7 @@ def process_config(filename, session, pathes_storage, files, all_time_downloaded
             section_favs = default_favs
             section_ratings = default_ratings
             section_cond_func = default_condition
+            section_cond_source = None
             section_blacklist = []
             section_whitelist = []
             section_anylist = []
@@ -599,6 +1154,7 @@ def process_config(filename, session, pathes_storage, files, all_time_downloaded
                         source_template, tags = local.tags_and_source_template(value.lower().strip())
                         tags = [get_tag_alias(tag.lower(), api_key, login, session) for tag in tags]
                         section_cond_func = local.make_check_funk(source_template, tags)
+                        section_cond_source = (source_template, tuple(tags))
                 elif option.lower() in {'posts_from', 'posts_func', 'posts_source', 'post_from', 'post_func', 'post_source'}:
                     if value.lower() in {'db','database','local'}:
                         section_gen_func=storage.gen
@@ -620,9 +1176,7 @@ def process_config(filename, session, pathes_storage, files, all_time_downloaded
             section_tags += ['-'+tag for tag in blacklist+section_blacklisted]
             #section_search_tags = [tag for tag in section_tags if '*' not in tag][:38]
             section_search_tags = section_tags[:constants.MAX_USER_SEARCH_TAGS]
-            section_blacklist=[re.compile(re.escape(mask).replace('\\*','.*')) for mask in section_blacklist+section_blacklisted]
-            section_whitelist=[re.compile(re.escape(mask).replace('\\*','.*')) for mask in section_whitelist]
-            section_anylist = [re.compile(re.escape(mask).replace('\\*','.*')) for mask in section_anylist]
+            section_blacklist += section_blacklisted
             
             section_has_actual_search = \
                 check_has_actual_search(section_whitelist, section_blacklist, section_anylist, section_cond_func)
@@ -631,7 +1185,9 @@ def process_config(filename, session, pathes_storage, files, all_time_downloaded
             # Append the final values that will be used for the specific section to the list of searches.
             # Note section_tags is a list within a list.
             
-            section_blacklist +=[re.compile(re.escape(mask).replace('\\*','.*')) for mask in blacklist]
+            section_blacklist = local.TagMatcher(section_blacklist + blacklist)
+            section_whitelist = local.TagMatcher(section_whitelist)
+            section_anylist = local.TagMatcher(section_anylist)
             
             if section_id[0] == "*":
                 section_directory = section_id[1:]
@@ -649,6 +1205,7 @@ def process_config(filename, session, pathes_storage, files, all_time_downloaded
                              'whitelist': section_whitelist, 
                              'anylist': section_anylist,
                              'cond_func': section_cond_func,
+                             'cond_source': section_cond_source,
                              'gen_funcs': section_gen_func,
                              'append_func': section_append_func,
                              'posts_countdown': section_post_limit,
@@ -672,7 +1229,8 @@ def process_config(filename, session, pathes_storage, files, all_time_downloaded
     local.printer.change_status("Checking for partial downloads")
 
     if not full_offline:
-        downloaded = remote.finish_partial_downloads(session, cachefunc, duplicate_func, files, api_key, login)
+        downloaded = remote.finish_partial_downloads(session, cachefunc, duplicate_func, files, api_key, login,
+                                                     md5_mismatch, download_queue.known_posts())
         if downloaded:
             local.append_files(files, downloaded)
     # files = local.get_files_dict(config_queue.reset_filedb)
@@ -681,140 +1239,161 @@ def process_config(filename, session, pathes_storage, files, all_time_downloaded
         for pf in prefilter:
             pf['days_ago'] = max_days_ago
         kwargs = prefilter
+        scan_targets = {}
     else:
-        kwargs = [search for search in searches if not download_queue.in_gens(search['directory'])]
+        scans, scan_targets = plan_scans(searches)
+        kwargs = [scan for scan in scans if not download_queue.in_gens(scan['directory'])]
+    
+    # daemon mode scans only sections whose poll interval has passed
+    if due_sections is not None and not prefilter:
+        kwargs = [scan for scan in kwargs if scan_targets.get(scan['directory'], {scan['directory']}) & due_sections]
+    
+    watermarks.discard_pending()
+    if incremental_sync and watermarks.enabled:
+        for scan in kwargs:
+            if not is_incremental(scan):
+                continue
+            if prefilter:
+                targets = searches
+            else:
+                targets = [searches_dict[directory] for directory in scan_targets.get(scan['directory'], {scan['directory']})]
+            scan['watermark_key'] = watermark_key(scan, targets)
+            scan['watermark'] = watermarks.get(scan['watermark_key'])
 
     local.printer.change_status("Downloading files")
-    queue_thread=Thread(target=prefilter_build_index, args=(kwargs, use_db, searches))
+    profiler.begin(filename)
+    del producer_errors[:]
+    queue_thread=Thread(target=profiler.wrap(prefilter_build_index, 'producer'), args=(kwargs, use_db, searches))
     queue_thread.start()
     
-    download_pool=ThreadPoolExecutor(max_workers=2)
+    def submit_download(search, post, verdicts):
+        directory = search['directory']
+        format = search['format']
+        make_pooled_subfolder = search['make_pooled_subfolder']
+        move_pooled = search['move_pooled']
+
+        if format:
+            id_ext = f'{post.id}.{post.file_ext}'
+            
+            # TODO: make all pathes absolute at least at the place they are actually used
+            custom_prefix = format.format(**post.generate())[:100]  
+            filename = f'{custom_prefix}.{id_ext}'
+        else:
+            filename = f'{post.id}.{post.file_ext}'
+        
+        poolless_unfiltered_directories = get_directories(post, [directory], search, searches_dict, verdicts)
+        
+        # Here be pools
+        # First, check if post has pools.
+        # Second, if it is, for every directory add copy to <dir>/pools/<name_of_pool>
+        
+        
+        pooled_unfiltered_directories=[]
+        if make_pooled_subfolder and poolless_unfiltered_directories:
+            pools = get_pools(post)
+            for pool in pools:
+                pooled_unfiltered_directories_per_pool=[]
+                for dir in poolless_unfiltered_directories:
+                    pooled_unfiltered_directories.append(f"{dir}/pools/{pool}")
+                    pooled_unfiltered_directories_per_pool.append(f"{dir}/pools/{pool}")
+
+                if pool_download_generate:
+                    local.add_pool_folders(pools_folders, pool, pooled_unfiltered_directories_per_pool)
+                
+        if make_pooled_subfolder and pooled_unfiltered_directories:
+            if move_pooled:
+                unfiltered_directories = pooled_unfiltered_directories
+            else:
+                unfiltered_directories = pooled_unfiltered_directories + poolless_unfiltered_directories
+        else:
+            unfiltered_directories = poolless_unfiltered_directories
+        # Third, if there is a flag, add said directory to list pairs of pairs pool-directory and list of all pools, and save it.
+        # Forth, if there is a flag, remove original path and replace for pooled
+        # Fifth, if there is a flag, at the end of all non-generated configs, (re)generate config for pools and execute it
+        
+        directories = []
+        for unfiltered_directory in unfiltered_directories:
+            if pathes_storage.make_path(unfiltered_directory, filename) not in all_time_downloaded:
+                directories.append(unfiltered_directory)
+        if not directories:
+            local.printer.increment_filtered(1)
+            return None
+        
+        pathes_storage.add_pathes(directories, filename)
+        return download_pool.submit(profiler.wrap(get_files, 'downloads'),
+            post, filename, directories, files,
+            session, cachefunc, duplicate_func, download_post, search, api_key, login, md5_mismatch)
+
+    # actual number of simultaneous downloads is limited by download_set
+    download_pool=ThreadPoolExecutor(max_workers=download_set.max_threads)
+    pipeline = DownloadPipeline(submit_download, pathes_storage, pools_folders)
+    profiler.enable('download_loop')
     try:
         while True:
-            try:
-                chunk_directory, chunk = download_queue.first()
-            except:
+            pipeline.process_completed()
             
-                if download_queue.aborted:
-                    break
+            closed = download_queue.closed
+            if len(pipeline) < constants.DOWNLOAD_CHUNKS_AHEAD:
+                try:
+                    chunk_directory, chunk = download_queue.nth(len(pipeline))
+                except IndexError:
+                    if closed and not pipeline:
+                        break
                 else:
-                    sleep(0.5)
-                    continue
-    
-            results_pair = []
-            for search in searches:
-                directory = search['directory']
-                if chunk_directory.lower() != directory.lower() and not is_prefilter(chunk_directory.lower()):
-                    continue
-
-                results_pair += list(zip([search]*len(chunk), chunk))
-            
-            while results_pair:
-                futures = []
-                remaining_from_countdown=[]
-                
-                pathes_storage.begin()
-                for search, post in results_pair:
-                    directory = search['directory']
-                    format = search['format']
-                    make_pooled_subfolder = search['make_pooled_subfolder']
-                    move_pooled = search['move_pooled']
-                    if search['posts_countdown'] <= 0:
-                        remaining_from_countdown.append( (search, post) )
-                        continue
-
-                    if format:
-                        id_ext = f'{post.id}.{post.file_ext}'
-                        
-                        # TODO: make all pathes absolute at least at the place they are actually used
-                        custom_prefix = format.format(**post.generate())[:100]  
-                        filename = f'{custom_prefix}.{id_ext}'
-                    else:
-                        filename = f'{post.id}.{post.file_ext}'
-                    
-                    poolless_unfiltered_directories = get_directories(post, [directory], search, searches_dict)
-                    
-                    # Here be pools
-                    # First, check if post has pools.
-                    # Second, if it is, for every directory add copy to <dir>/pools/<name_of_pool>
-                    
-                    
-                    pooled_unfiltered_directories=[]
-                    if make_pooled_subfolder and poolless_unfiltered_directories:
-                        pools = get_pools(post)
-                        for pool in pools:
-                            pooled_unfiltered_directories_per_pool=[]
-                            for dir in poolless_unfiltered_directories:
-                                pooled_unfiltered_directories.append(f"{dir}/pools/{pool}")
-                                pooled_unfiltered_directories_per_pool.append(f"{dir}/pools/{pool}")
-
-                            if pool_download_generate:
-                                pools_folders.setdefault(pool,[]).extend(pooled_unfiltered_directories_per_pool)
-                            
-                    if make_pooled_subfolder and pooled_unfiltered_directories:
-                        if move_pooled:
-                            unfiltered_directories = pooled_unfiltered_directories
-                        else:
-                            unfiltered_directories = pooled_unfiltered_directories + poolless_unfiltered_directories
-                    else:
-                        unfiltered_directories = poolless_unfiltered_directories
-                    # Third, if there is a flag, add said directory to list pairs of pairs pool-directory and list of all pools, and save it.
-                    # Forth, if there is a flag, remove original path and replace for pooled
-                    # Fifth, if there is a flag, at the end of all non-generated configs, (re)generate config for pools and execute it
-                    
-                    directories = []
-                    for unfiltered_directory in unfiltered_directories:
-                        if pathes_storage.make_path(unfiltered_directory, filename) not in all_time_downloaded:
-                            directories.append(unfiltered_directory)
-                    if directories:
-                        
-                        pathes_storage.add_pathes(directories, filename)
-                        futures.append(download_pool.submit(get_files,
-                            post, filename, directories, files,
-                            session, cachefunc, duplicate_func, download_post, search, api_key, login))
-                        
-                        search['posts_countdown'] -= 1
+                    # every search of the chunk checked at once
+                    if batch.available():
+                        with metrics.timer('classify_seconds'):
+                            verdicts = batch.classify(chunk, searches_dict.values())
                     else:
-                        local.printer.increment_filtered(1)
-                pathes_storage.commit()
-                
-                pathes_storage.begin()
-                for future in futures:
-                    if future.exception():
-                        raise future.exception()
+                        verdicts = None
                     
-                    #Recovering wrong countdown decrement
-                    #Still not good and may lead to less post than
-                    #max_posts. But better than it was
-                    search, success, directories, filename = future.result()
-                    if not success:
-                        search['posts_countdown'] += 1
-                    else:
-                        pathes_storage.add_all_time_downloaded(directories, filename)
-                pathes_storage.commit()
-                results_pair = []
-                for search, post in remaining_from_countdown:
-                    if search['posts_countdown'] > 0:
-                        results_pair.append((search, post))
+                    results_pair = []
+                    targets = scan_targets.get(chunk_directory.lower(), {chunk_directory.lower()})
+                    for search in searches:
+                        directory = search['directory']
+                        if directory.lower() not in targets and not is_prefilter(chunk_directory.lower()):
+                            continue
+
+                        results_pair += [(search, post, verdicts) for post in chunk]
                     
-            download_queue.popleft()
-            local.save_pools(pools_folders)
-            download_queue.save()
+                    pipeline.add_chunk(results_pair)
+                    continue
             
+            # Sleeps until something can be done. Only a finished download
+            # can help if enough chunks are in progress or no more will come.
+            if closed or len(pipeline) >= constants.DOWNLOAD_CHUNKS_AHEAD:
+                pipeline.process_completed(timeout=constants.DOWNLOAD_QUEUE_WAIT)
+            else:
+                download_queue.wait(len(pipeline), pipeline.has_completed, constants.DOWNLOAD_QUEUE_WAIT)
 
     except: #Pull request a better way
+        if daemon_mode:
+            # stop API thread and downloads, queue is saved as it is
+            download_queue.close()
+            pipeline.cancel()
+            download_pool.shutdown(wait=True)
+            queue_thread.join()
+            profiler.disable('download_loop')
+            profiler.end()
+            raise
         local.printer.show(False)
         local.printer.stop()
         local.printer.join()
         local.printer.reset_screen()
         print("Exception during download:")
         print_exc()
-        download_queue.save()
+        save_on_exit()
         os._exit(0)
     
+    profiler.disable('download_loop')
     queue_thread.join()
+    profiler.end()
+    
+    if producer_errors:
+        raise producer_errors.pop()
     
     if download_queue.completed:
+        watermarks.commit()
         download_queue.reset()
     
     return
@@ -0,0 +1,122 @@
+# Internal Imports
+import re
+
+# External Imports
+# numpy is optional. Without it every post
+# is checked by process_result one by one.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Personal Imports
+from .local import mask_to_regex
+
+RATING_CODES = {'s': 0, 'q': 1, 'e': 2}
+UNKNOWN_RATING = 3
+
+def available():
+    return numpy is not None
+
+class PostBatch:
+    # Posts of one chunk as columns: every tag gets an integer id,
+    # and for every tag id there is a sorted run of post indexes,
+    # so any tag or mask becomes a boolean column over the whole batch.
+    def __init__(self, posts):
+        self.posts = posts
+        self.size = len(posts)
+
+        self.ids = numpy.fromiter((post.id for post in posts), dtype=numpy.int64, count=self.size)
+        self.score = numpy.fromiter((int(post.score) for post in posts), dtype=numpy.int64, count=self.size)
+        self.fav_count = numpy.fromiter((int(post.fav_count) for post in posts), dtype=numpy.int64, count=self.size)
+        self.days_ago = numpy.fromiter((post.days_ago for post in posts), dtype=numpy.float64, count=self.size)
+        self.rating = numpy.fromiter((RATING_CODES.get(post.rating, UNKNOWN_RATING) for post in posts), dtype=numpy.int8, count=self.size)
+
+        self.tag_ids = {}
+        entry_tags = []
+        entry_posts = []
+        for index, post in enumerate(posts):
+            for tag in post.post_tags().set:
+                entry_tags.append(self.tag_ids.setdefault(tag, len(self.tag_ids)))
+                entry_posts.append(index)
+
+        entry_tags = numpy.array(entry_tags, dtype=numpy.int32)
+        entry_posts = numpy.array(entry_posts, dtype=numpy.int32)
+        order = numpy.argsort(entry_tags, kind='stable')
+        self._posts_by_tag = entry_posts[order]
+        counts = numpy.bincount(entry_tags, minlength=len(self.tag_ids))
+        self._starts = numpy.concatenate(([0], numpy.cumsum(counts)))
+
+        self._columns = {}
+
+    def _column_for_ids(self, tag_ids):
+        column = numpy.zeros(self.size, dtype=bool)
+        for tag_id in tag_ids:
+            column[self._posts_by_tag[self._starts[tag_id]:self._starts[tag_id+1]]] = True
+        return column
+
+    def exact_column(self, tag):
+        key = ('exact', tag)
+        if key not in self._columns:
+            tag_id = self.tag_ids.get(tag)
+            self._columns[key] = self._column_for_ids([] if tag_id is None else [tag_id])
+        return self._columns[key]
+
+    def column(self, mask):
+        if '*' not in mask:
+            return self.exact_column(mask)
+
+        key = ('mask', mask)
+        if key not in self._columns:
+            reg = re.compile(mask_to_regex(mask))
+            self._columns[key] = self._column_for_ids([tag_id for tag, tag_id in self.tag_ids.items() if reg.fullmatch(tag)])
+        return self._columns[key]
+
+def compile_condition(cond_source):
+    # Same expression as local.make_check_funk makes,
+    # but over boolean columns instead of a set of tags.
+    # Precedence of ~ & | is the same as of not, and, or here.
+    source_template, tags = cond_source
+    source = source_template.replace("('{}' in tags)", "(c[{}])")
+    source = source.format(*range(len(tags)))
+    source = source.replace(' not ', ' ~ ').replace(' or ', ' | ').replace(' and ', ' & ')
+    func = eval(f'lambda c: {source}')
+    return lambda batch: func([batch.exact_column(tag) for tag in tags])
+
+_compiled_conditions = {}
+
+def section_mask(batch, whitelist, blacklist, anylist, cond_source, ratings, min_score, min_favs, days_ago, has_actual_search, **dummy):
+    if not has_actual_search:
+        return numpy.zeros(batch.size, dtype=bool)
+
+    mask = numpy.ones(batch.size, dtype=bool)
+    for tag in whitelist.masks:
+        mask &= batch.column(tag)
+    for tag in blacklist.masks:
+        mask &= ~batch.column(tag)
+    if anylist:
+        any_mask = numpy.zeros(batch.size, dtype=bool)
+        for tag in anylist.masks:
+            any_mask |= batch.column(tag)
+        mask &= any_mask
+
+    if cond_source:
+        if cond_source not in _compiled_conditions:
+            _compiled_conditions[cond_source] = compile_condition(cond_source)
+        mask &= _compiled_conditions[cond_source](batch)
+
+    mask &= numpy.isin(batch.rating, [RATING_CODES.get(rating, UNKNOWN_RATING) for rating in ratings])
+    mask &= batch.score >= min_score
+    mask &= batch.fav_count >= min_favs
+    mask &= batch.days_ago < days_ago
+    return mask
+
+def filter_posts(posts, **search):
+    batch = PostBatch(posts)
+    mask = section_mask(batch, **search)
+    return [post for post, passed in zip(posts, mask.tolist()) if passed]
+
+def classify(posts, searches):
+    # {directory: ids of posts that pass filters of that search}
+    batch = PostBatch(posts)
+    return {search['directory']: set(batch.ids[section_mask(batch, **search)].tolist()) for search in searches}
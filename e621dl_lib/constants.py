@@ -1,9 +1,108 @@
+import os
+
 VERSION = '5.11.1'
 
+# Where API requests go. Can be changed with E621DL_API_URL
+# environment variable, e.g. to run against bench/fake_e621.py
+API_BASE_URL = os.environ.get('E621DL_API_URL', 'https://e621.net').rstrip('/')
+
 MAX_RESULTS = 320
 MAX_RESULTS_OFFLINE = 32000
 PARTIAL_DOWNLOAD_EXT = 'request'
 
+# e621 takes up to 100 ids in one id: search
+PARTIALS_PER_REQUEST = 100
+
+# names in one tags.json or tag_aliases.json request
+TAGS_PER_REQUEST = 100
+
+# Checked tags and aliases are not checked again for this many days.
+# 0 turns tag cache off.
+TAG_CACHE_DAYS = 7
+
+# Daemon mode (--daemon): default seconds between scans of a section,
+# and how often configs are checked for changes
+POLL_INTERVAL = 60*60
+CONFIG_CHECK_INTERVAL = 60
+# failed configs are logged here and retried after CONFIG_CHECK_INTERVAL
+DAEMON_ERROR_LOG = 'daemon_errors.log'
+
+# Metrics (metrics = true): summary written on exit, Prometheus text
+# file rewritten every METRICS_INTERVAL seconds while running.
+# Buckets are upper bounds of histograms.
+METRICS_JSON_FILE = 'metrics.json'
+METRICS_PROMETHEUS_FILE = 'metrics.prom'
+METRICS_INTERVAL = 15
+METRICS_TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_RATE_BUCKETS = tuple(1024 * 4**power for power in range(10)) # 1 KiB/s to 256 MiB/s
+METRICS_DEPTH_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+# Profiling (profile = true): reports of every config go to PROFILES_DIR,
+# functions by cumulative time and allocations by line
+PROFILES_DIR = 'profiles'
+PROFILE_TOP_FUNCTIONS = 50
+PROFILE_TOP_ALLOCATIONS = 30
+TRACEMALLOC_FRAMES = 1
+
+# default SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+SQLITE_MAX_VARIABLES = 999
+
+# Databases are in WAL mode. synchronous = NORMAL syncs only on checkpoints:
+# power loss can lose last commits, but never breaks a database.
+# mmap and cache sizes are in bytes, busy timeout in seconds.
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_MMAP_SIZE = 256*1024*1024
+SQLITE_CACHE_SIZE = 64*1024*1024
+SQLITE_BUSY_TIMEOUT = 30
+
+# jobs waiting for storage writer thread before submitting one more blocks
+SQLITE_WRITE_QUEUE = 64
+
+# How many chunks from download queue can be downloaded at the same time.
+# Next chunk is started while previous one still has slow downloads.
+DOWNLOAD_CHUNKS_AHEAD = 3
+
+# Download queue and pools are saved as journals of changes,
+# rewritten in full when journal grows over this many bytes
+JOURNAL_COMPACT_SIZE = 8*1024*1024
+
+# Download loop and API thread wake each other up, this is only
+# the longest sleep in case something goes wrong
+DOWNLOAD_QUEUE_WAIT = 5.0
+
+# Static file host is not limited like API is.
+# Default number of simultaneous downloads
+# and upper bound for download_threads = auto
+DOWNLOAD_THREADS = 2
+MAX_DOWNLOAD_THREADS = 16
+
+# What to do if md5 of downloaded file is not the one e621 reports:
+# 'retry' downloads it again from scratch up to MD5_RETRIES times
+# and then quarantines it, 'quarantine' moves it to QUARANTINE_DIR,
+# 'keep' leaves it in place with a warning.
+MD5_MISMATCH = 'retry'
+MD5_RETRIES = 2
+QUARANTINE_DIR = 'quarantine'
+HASH_READ_SIZE = 1024*1024
+
+# Downloads are read in chunks from DOWNLOAD_CHUNK_MIN to DOWNLOAD_CHUNK_MAX bytes,
+# chunk size grows while a chunk takes less than DOWNLOAD_CHUNK_TIME to arrive.
+# Up to WRITE_BEHIND_BUFFERS chunks per download wait to be written to disk.
+DOWNLOAD_CHUNK_MIN = 64*1024
+DOWNLOAD_CHUNK_MAX = 1024*1024
+DOWNLOAD_CHUNK_TIME = 0.25
+WRITE_BEHIND_BUFFERS = 4
+
+# written size of preallocated partial download, in seconds between saves
+PROGRESS_EXT = 'progress'
+PROGRESS_SAVE_INTERVAL = 1.0
+
+# Files of at least SEGMENTED_MIN_SIZE bytes, mostly videos, are downloaded
+# as DOWNLOAD_SEGMENTS byte ranges at the same time
+SEGMENTED_MIN_SIZE = 32*1024*1024
+DOWNLOAD_SEGMENTS = 4
+SEGMENTS_EXT = 'segments'
+
 # first number: time to establish connection
 # second number: max wait between bytes sent
 # aka (connect timeout, read timeout)
@@ -11,6 +110,23 @@ CONNECTION_TIMEOUT = (6.1, 15.5)
 
 MAX_USER_SEARCH_TAGS = 38 #one for time tag, one for id tag
 
+# Stored posts bigger than this, mostly because of description,
+# are compressed with zlib
+RECORD_COMPRESS = True
+RECORD_COMPRESS_MIN_SIZE = 256
+
+# Smaller batches are filtered post by post even if numpy is installed,
+# building columns for them costs more than it saves
+BATCH_FILTER_MIN_POSTS = 1000
+
+# Citation from e621:api
+# "You should make a best effort not to make
+# more than one request per second over a sustained period."
+# Sustained requests per second and how many requests
+# can be sent back to back after a pause.
+API_RATE_LIMIT = 1.0
+API_BURST = 1
+
 # 'author' is a field I just don't know anything about
 # I'll leave it for now.
 # 'creator_id' is now 'uploader_id' in e621 API
@@ -39,6 +155,18 @@ DEFAULT_CONFIG_TEXT = ''';;;;;;;;;;;;;;
 ;api_key = your e621 api key generated in account settings
 ;no_redownload = true
 ;pool_download_generate = true
+;api_rate = 1
+;api_burst = 1
+;download_threads = 2
+;max_download_threads = 16
+;md5_mismatch = retry
+;tag_cache_days = 7
+;refresh_tag_cache = false
+;incremental_sync = true
+;metrics = true
+;metrics_interval = 15
+;profile = true
+;profile_memory = true
 
 ;These are default settings for all search groups below
 ;[Defaults]
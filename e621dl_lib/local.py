@@ -4,11 +4,13 @@ import datetime
 import os
 import atexit
 import sys
-from threading import Thread, Lock, Condition
+from threading import Thread, Lock, RLock, Condition
 from collections import deque
-import sqlite3
+from queue import Queue
 import pickle
-from time import sleep
+import struct
+import zlib
+from time import sleep, time
 from functools import lru_cache
 import hashlib
 from shutil import get_terminal_size, move
@@ -16,6 +18,8 @@ from contextlib import contextmanager, suppress
 import glob
 import re
 import json
+import csv
+from itertools import islice
 
 # External Imports
 import colorama
@@ -24,6 +28,9 @@ from atomicwrites import atomic_write, replace_atomic
 
 # Personal Imports
 from . import constants
+from . import records
+from . import storage
+from .metrics import metrics
 
 class StatPrinter(Thread):
     def __init__(self):
@@ -42,12 +49,16 @@ class StatPrinter(Thread):
                       'recent warning' : 'None so far',
                       'recent file downloaded' : 'None so far',
                       'connection retries' : 0,
+                      'rate limit wait' : 'None so far',
+                      'download threads' : constants.DOWNLOAD_THREADS,
                       'posts so far' : 0,
                       'already exist': 0,
                       'downloaded' : 0,
                       'copied' : 0,
                       'filtered' : 0,
+                      'api pages saved' : 0,
                       'not found on e621' : 0,
+                      'md5 mismatches' : 0,
                       }
 
     def stop(self):
@@ -98,6 +109,12 @@ class StatPrinter(Thread):
     def change_warning(self, text):
         self.messages.append({'recent warning' : text})
     
+    def change_rate_wait(self, text):
+        self.messages.append({'rate limit wait' : text})
+    
+    def change_download_threads(self, amount):
+        self.messages.append({'download threads' : amount})
+    
     def increment_retries(self):
         self._increments.append(('connection retries', 1))
     
@@ -119,6 +136,12 @@ class StatPrinter(Thread):
     def increment_filtered(self, amount):
         self._increments.append(('filtered' , amount))
     
+    def increment_pages_saved(self, amount):
+        self._increments.append(('api pages saved' , amount))
+    
+    def increment_md5_mismatches(self):
+        self._increments.append(('md5 mismatches' , 1))
+    
     
     
     def show(self, val = True):
@@ -128,11 +151,76 @@ class StatPrinter(Thread):
 printer = StatPrinter()
 
 class ActiveDownloadsSet:
-    def __init__(self, max_downloads = 2):
+    # Limits number of simultaneous downloads.
+    # In adaptive mode the limit follows AIMD: one more download
+    # while estimated total throughput keeps growing,
+    # half as many on connection errors or server overload.
+    def __init__(self, max_downloads = constants.DOWNLOAD_THREADS):
         self._cv = Condition(lock=Lock())
         self._active_downloads = set()
         self._max_downloads = max_downloads
+        self.max_threads = max_downloads
+        self._adaptive = False
+        self._best_rate = 0.0
+        self._reset_window()
+    
+    def configure(self, max_downloads, adaptive = False, max_threads = constants.MAX_DOWNLOAD_THREADS):
+        with self._cv:
+            self._adaptive = adaptive
+            if adaptive:
+                self.max_threads = max(1, max_threads)
+                self._max_downloads = min(max(1, max_downloads), self.max_threads)
+            else:
+                self.max_threads = max(1, max_downloads)
+                self._max_downloads = self.max_threads
+            self._best_rate = 0.0
+            self._reset_window()
+            printer.change_download_threads(self._max_downloads)
+            self._cv.notify_all()
+    
+    def _reset_window(self):
+        self._window_bytes = 0
+        self._window_seconds = 0.0
+        self._window_active = 0
+        self._window_count = 0
+        self._window_errors = 0
+    
+    def _adjust(self):
+        if self._window_errors:
+            self._max_downloads = max(1, self._max_downloads // 2)
+            self._best_rate = 0.0
+        elif self._window_seconds > 0:
+            # bytes per second of one download times how many were running
+            rate = self._window_bytes / self._window_seconds * self._window_active / self._window_count
+            if rate > self._best_rate * 1.1:
+                self._max_downloads = min(self.max_threads, self._max_downloads + 1)
+                self._best_rate = rate
+            else:
+                # slowly forget old best, so we probe for more bandwidth later
+                self._best_rate = max(rate, self._best_rate * 0.9)
         
+        printer.change_download_threads(self._max_downloads)
+        self._reset_window()
+        self._cv.notify_all()
+    
+    def report_download(self, nbytes, seconds):
+        with self._cv:
+            if not self._adaptive:
+                return
+            self._window_bytes += nbytes
+            self._window_seconds += seconds
+            self._window_active += len(self._active_downloads)
+            self._window_count += 1
+            if self._window_count >= 2 * self._max_downloads:
+                self._adjust()
+    
+    def report_error(self):
+        with self._cv:
+            if not self._adaptive:
+                return
+            self._window_errors += 1
+            self._adjust()
+    
     def add_id(self, id):
         def _predicate():
             return (len(self._active_downloads) < self._max_downloads
@@ -154,51 +242,249 @@ class ActiveDownloadsSet:
             yield
         finally:
             self.remove_id(id)
+
+download_set = ActiveDownloadsSet()
             
+class Journal:
+    # Append-only log of changes made after a snapshot was saved.
+    # Starts with magic and generation of the snapshot it belongs to,
+    # then records: uint32 length, uint32 crc32, pickled change.
+    # Journal of an older generation was already compacted into
+    # the snapshot and is ignored. Record cut by a crash fails its
+    # crc, it and everything after it is dropped.
+    MAGIC = b'E6JL'
+    _header = struct.Struct('<4sQ')
+    _record = struct.Struct('<II')
+    
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+        self._file = None
+        self._size = 0
+    
+    def read(self, generation):
+        self.close()
+        self.generation = generation
+        self._size = 0
+        changes = []
+        try:
+            with open(self.path, 'rb') as infile:
+                data = infile.read()
+        except FileNotFoundError:
+            return changes
+        
+        if len(data) < self._header.size or self._header.unpack_from(data) != (self.MAGIC, generation):
+            return changes
+        
+        position = self._header.size
+        while position + self._record.size <= len(data):
+            length, crc = self._record.unpack_from(data, position)
+            payload = data[position + self._record.size:position + self._record.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            try:
+                changes.append(pickle.loads(payload))
+            except Exception:
+                break
+            position += self._record.size + length
+        self._size = position
+        return changes
+    
+    def _open(self):
+        if self._file:
+            return
+        if self._size:
+            # valid part of existing journal, torn tail is cut off
+            self._file = open(self.path, 'r+b')
+            self._file.truncate(self._size)
+            self._file.seek(self._size)
+        else:
+            self._file = open(self.path, 'wb')
+            self._file.write(self._header.pack(self.MAGIC, self.generation))
+            self._size = self._header.size
+    
+    def append(self, change):
+        self._open()
+        payload = pickle.dumps(change, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.write(self._record.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._file.flush()
+        self._size += self._record.size + len(payload)
+    
+    def sync(self):
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+    
+    @property
+    def size(self):
+        return self._size
+    
+    def restart(self, generation):
+        # called after snapshot of this generation is saved
+        self.close()
+        self.generation = generation
+        self._size = 0
+        with suppress(FileNotFoundError):
+            os.remove(self.path)
+    
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
 class DownloadQueue:
+    # Chunks of posts from API thread to download loop.
+    # Producer blocks while queue is full, consumer blocks while it has
+    # nothing new. close() tells consumer no more chunks will come.
+    #
+    # Every change is appended to download_queue.journal as it happens,
+    # save() only syncs it. Whole queue is pickled to download_queue.pickle
+    # when journal grows over JOURNAL_COMPACT_SIZE or queue is reset.
     def __init__(self):
-        self._lock = Lock()
+        # reentrant, so save() from a signal handler can't deadlock
+        self._lock = RLock()
+        self._cv = Condition(self._lock)
+        self._journal = Journal('download_queue.journal')
         
         try:
             self.load()
         except:
-            self.reset()
+            self._reset()
+            self._journal.restart(self._generation)
 
-        self.aborted = False
+        self._closed = False
+    
+    def _apply(self, change):
+        kind = change[0]
+        if kind == 'append':
+            dummy_kind, item, last_id = change
+            self._deque.append(item)
+            if last_id is not None:
+                self._last_id = last_id
+        elif kind == 'popleft':
+            self._deque.popleft()
+        elif kind == 'last_id':
+            self._last_id = change[1]
+        elif kind == 'completed':
+            self._completed = change[1]
+        elif kind == 'completed_gen':
+            self.completed_deque.append(change[1])
+            self._last_id = 0x7F_FF_FF_FF
+    
+    def _change(self, *change):
+        self._apply(change)
+        self._journal.append(change)
 
     def popleft(self):
-        with self._lock:
-            return self._deque.popleft()
+        with self._cv:
+            item = self._deque[0]
+            self._change('popleft')
+            metrics.set('download_queue_depth', len(self._deque))
+            self._cv.notify_all()
+            return item
 
-    def append(self, arg, maxlen=10):
-        while True:
-            with self._lock:
-                if len(self._deque) < maxlen:
-                    break
-            sleep(0.02)
-        
+    def append(self, arg, maxlen=10, timeout=None, last_id=None):
+        # False if there was no room in time or queue was closed.
+        # last_id is saved in the same record, so chunk and
+        # the id to continue from can't disagree after a crash
+        with self._cv:
+            if not self._cv.wait_for(lambda: len(self._deque) < maxlen or self._closed, timeout):
+                return False
+            if self._closed:
+                return False
+            # depth seen by producer, full queue means downloads are behind
+            metrics.observe('download_queue_depth_on_append', len(self._deque), constants.METRICS_DEPTH_BUCKETS)
+            self._change('append', arg, last_id)
+            metrics.set('download_queue_depth', len(self._deque))
+            self._cv.notify_all()
+            return True
+    
+    def wait(self, index, ready=None, timeout=None):
+        # Until there is an item at index, queue is closed or ready() is true.
+        # ready is checked under the lock, so wake() after its condition
+        # became true is never missed.
+        with self._cv:
+            return self._cv.wait_for(lambda: len(self._deque) > index or self._closed or (ready is not None and ready()), timeout)
+    
+    def wake(self):
+        with self._cv:
+            self._cv.notify_all()
+    
+    def close(self):
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+    
+    def reopen(self):
+        with self._cv:
+            self._closed = False
+    
+    @property
+    def closed(self):
+        with self._lock:
+            return self._closed
+    
+    @property
+    def last_id(self):
         with self._lock:
-            return self._deque.append(arg)
+            return self._last_id
+    
+    @last_id.setter
+    def last_id(self, value):
+        with self._lock:
+            self._change('last_id', value)
+    
+    @property
+    def completed(self):
+        with self._lock:
+            return self._completed
+    
+    @completed.setter
+    def completed(self, value):
+        with self._lock:
+            self._change('completed', value)
     
     def save(self):
+        # journal is already written, this makes sure it's on disk
         with self._lock:
-            with atomic_write('download_queue.pickle', mode='wb', overwrite=True) as download_queue_file:
-                pickle.dump((
-                             self.last_id,
-                             self.completed,
-                             self._deque,
-                             self.completed_deque,
-                             self.config_hash
-                            ), download_queue_file, protocol=pickle.HIGHEST_PROTOCOL)
+            if self._journal.size > constants.JOURNAL_COMPACT_SIZE:
+                self._compact()
+            else:
+                self._journal.sync()
+    
+    def _compact(self):
+        self._generation += 1
+        with atomic_write('download_queue.pickle', mode='wb', overwrite=True) as download_queue_file:
+            pickle.dump((
+                         self._generation,
+                         self._last_id,
+                         self._completed,
+                         self._deque,
+                         self.completed_deque,
+                         self.config_hash
+                        ), download_queue_file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._journal.restart(self._generation)
                 
     def load(self):
         with self._lock:
-            with open('download_queue.pickle', 'rb') as download_queue_file:
-                (self.last_id,
-                 self.completed,
+            try:
+                with open('download_queue.pickle', 'rb') as download_queue_file:
+                    state = pickle.load(download_queue_file)
+            except FileNotFoundError:
+                # nothing was compacted yet, everything is in journal
+                self._reset()
+            else:
+                # older versions had no generation and no journal
+                if len(state) == 5:
+                    state = (0,) + state
+                (self._generation,
+                 self._last_id,
+                 self._completed,
                  self._deque,
                  self.completed_deque,
-                 self.config_hash) = pickle.load(download_queue_file)
+                 self.config_hash) = state
+            for change in self._journal.read(self._generation):
+                self._apply(change)
     
     def last(self):
         with self._lock:
@@ -208,29 +494,44 @@ class DownloadQueue:
         with self._lock:
             return self._deque[0]
     
-    def reset(self):
+    def nth(self, index):
+        with self._lock:
+            return self._deque[index]
+    
+    def known_posts(self):
+        with self._lock:
+            return {post.id: post for directory, posts in self._deque for post in posts}
+    
+    def _reset(self):
         self._deque=deque()
-        self.completed=False
-        self.last_id = 0x7F_FF_FF_FF
+        self._completed=False
+        self._last_id = 0x7F_FF_FF_FF
         self.completed_deque=deque()
+        self._generation = getattr(self, '_generation', 0)
         try:
             self.config_hash #checking if hash exists
         except:
             self.config_hash=None
+    
+    def reset(self):
+        # empty queue is cheap to save, journal starts over
+        with self._lock:
+            self._reset()
+            self._compact()
         
     def is_reset(self):
         return self.last_id == 0x7F_FF_FF_FF
        
     def completed_gen(self, name):
         with self._lock:
-            self.completed_deque.append(name)
-            self.last_id = 0x7F_FF_FF_FF
+            self._change('completed_gen', name)
     
     def check_config_hash(self, hash):
         with self._lock:
             if self.config_hash != hash:
-                self.reset()
+                self._reset()
                 self.config_hash = hash
+                self._compact()
             
     def in_gens(self, name):
         with self._lock:
@@ -288,62 +589,387 @@ class ConfigQueue:
         with self._lock:
             return natsorted(self.config_set - self.completed_set)
 
+class Watermarks:
+    # Highest post id that every search has seen in full, by search key.
+    # Next run asks API only for posts above it. New values are
+    # pending until the whole config is done, then saved all at once.
+    def __init__(self):
+        self._lock = Lock()
+        self.enabled = True
+        self._pending = {}
+        try:
+            self.load()
+        except:
+            self._marks = {}
+    
+    def save(self):
+        with self._lock:
+            with atomic_write('watermarks.pickle', mode='wb', overwrite=True) as watermarks_file:
+                pickle.dump(self._marks, watermarks_file, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    def load(self):
+        with self._lock:
+            with open('watermarks.pickle', 'rb') as watermarks_file:
+                self._marks = pickle.load(watermarks_file)
+    
+    def get(self, key):
+        with self._lock:
+            return self._marks.get(key)
+    
+    def set_pending(self, key, post_id):
+        with self._lock:
+            self._pending[key] = max(post_id, self._marks.get(key) or 0)
+    
+    def commit(self):
+        with self._lock:
+            self._marks.update(self._pending)
+            self._pending = {}
+        self.save()
+    
+    def discard_pending(self):
+        with self._lock:
+            self._pending = {}
+
+def glob_escape(mask):
+    # '*' stays a wildcard, everything else is literal
+    return mask.replace('[', '[[]').replace('?', '[?]')
+
 class PostsStorage:
+    # posts.db schema versions, stored in PRAGMA user_version:
+    # 0 - table "posts" of pickled posts
+    # 1 - table "post_data" with scalar columns and
+    #     "post_tags" inverted index, so filters can be done in SQL
+    # 2 - posts in "post_data" are records.encode_post records, not pickles
+    SCHEMA_VERSION = 2
+    
     def __init__(self):
-        pass
+        self._tag_ids = {}
+        self._pending = []
     
     def append(self, posts):
-        self.cur.executemany('INSERT OR REPLACE INTO posts VALUES (?,?)',
-            ( (post.id, pickle.dumps(post, protocol = pickle.HIGHEST_PROTOCOL) ) for post in posts) )
-        self.conn.commit()
+        # Rows are made here, filters change posts after that.
+        # Written by storage writer while next page is requested.
+        pending = []
+        for future in self._pending:
+            if future.done():
+                future.result() # earlier failures come out here
+            else:
+                pending.append(future)
+        data, tags = self._rows(posts)
+        future = storage.writer.submit('posts.db', lambda cur: self._write(cur, data, tags))
+        future.add_done_callback(self._cache_tag_ids)
+        pending.append(future)
+        self._pending = pending
+    
+    def _cache_tag_ids(self, future):
+        # Only ids of committed tags are remembered. Ids of rolled back
+        # ones could be given by sqlite to other names later.
+        if not future.cancelled() and future.exception() is None:
+            self._tag_ids.update(future.result())
+    
+    def _tag_ids_of(self, cur, names):
+        # ids of all names, and ones that were not cached
+        tag_ids = {name: self._tag_ids[name] for name in names if name in self._tag_ids}
+        missing = [name for name in names if name not in tag_ids]
+        found = {}
+        if missing:
+            cur.executemany('INSERT OR IGNORE INTO tags (name) VALUES (?)', ( (name,) for name in missing ) )
+            for chunk in chunks(missing, constants.SQLITE_MAX_VARIABLES):
+                cur.execute(f"SELECT name, id FROM tags WHERE name IN ({','.join('?'*len(chunk))})", chunk)
+                found.update(cur.fetchall())
+        tag_ids.update(found)
+        return tag_ids, found
+    
+    @staticmethod
+    def _rows(posts):
+        data = [ (post.id, int(post.score), int(post.fav_count), post.rating, post.created_at['s'],
+                  post.file_ext, post.file_size, records.encode_post(post) ) for post in posts ]
+        # Metatags from search string are appended to post.tags,
+        # only real tags by category are indexed
+        tags = [ (tag, post.id) for post in posts for taglist in post.tag_ex.values() for tag in taglist ]
+        return data, tags
+    
+    def _write(self, cur, data, tags):
+        # returns ids of tags it added, to be cached after commit
+        cur.executemany('INSERT OR REPLACE INTO post_data VALUES (?,?,?,?,?,?,?,?)', data)
+        cur.executemany('DELETE FROM post_tags WHERE post_id = ?', ( (row[0],) for row in data ) )
+        tag_ids, found = self._tag_ids_of(cur, {name for name, post_id in tags})
+        cur.executemany('INSERT OR IGNORE INTO post_tags VALUES (?,?)',
+            ( (tag_ids[name], post_id) for name, post_id in tags ) )
+        return found
         
     def close(self):
-        self.cur.close()
-        self.conn.close()
+        pending, self._pending = self._pending, []
+        try:
+            for future in pending:
+                future.result()
+        finally:
+            self.cur.close()
+            self.conn.close()
         
     def connect(self):
-        self.conn = sqlite3.connect('posts.db')
+        # schema and conversions are done here, before writer gets any posts
+        self.conn = storage.connect('posts.db')
         self.cur = self.conn.cursor()
         self.cur.executescript(
-            '''CREATE TABLE IF NOT EXISTS posts (
-                id     INTEGER PRIMARY KEY
-                               UNIQUE
-                               NOT NULL,
-                struct BLOB
-            ) WITHOUT ROWID;'''
+            '''CREATE TABLE IF NOT EXISTS post_data (
+                id        INTEGER PRIMARY KEY
+                                  NOT NULL,
+                score     INTEGER,
+                fav_count INTEGER,
+                rating    TEXT,
+                created_at INTEGER,
+                file_ext  TEXT,
+                file_size INTEGER,
+                struct    BLOB
+            );
+            
+            CREATE INDEX IF NOT EXISTS post_data_created_at ON post_data (created_at);
+            
+            CREATE TABLE IF NOT EXISTS tags (
+                id        INTEGER PRIMARY KEY,
+                name      TEXT UNIQUE
+                               NOT NULL
+            );
+            
+            CREATE TABLE IF NOT EXISTS post_tags (
+                tag_id    INTEGER NOT NULL,
+                post_id   INTEGER NOT NULL,
+                PRIMARY KEY (tag_id, post_id)
+            ) WITHOUT ROWID;
+            
+            CREATE INDEX IF NOT EXISTS post_tags_post_id ON post_tags (post_id);'''
         )
         self.conn.commit()
+        self._tag_ids = {}
+        self.migrate()
         self.cur.arraysize= constants.MAX_RESULTS_OFFLINE
+    
+    def migrate(self):
+        self.cur.execute('PRAGMA user_version')
+        version = self.cur.fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        
+        self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='posts'")
+        if self.cur.fetchone():
+            printer.change_status("Converting posts.db to new format")
+            old_cur = self.conn.cursor()
+            old_cur.execute('SELECT struct FROM posts')
+            rows = old_cur.fetchmany(constants.MAX_RESULTS_OFFLINE)
+            while rows:
+                self._write(self.cur, *self._rows([records.load_post(row[0]) for row in rows]))
+                rows = old_cur.fetchmany(constants.MAX_RESULTS_OFFLINE)
+            old_cur.close()
+            self.cur.execute('DROP TABLE posts')
+        elif version < 2:
+            self.convert_records()
         
-    def gen(self, last_id, **dummy):
-        self.cur.execute('SELECT struct FROM posts WHERE id<=? ORDER BY id DESC', (last_id,))
-        results=[pickle.loads(result[0]) for result in self.cur.fetchmany()]
-        #TODO: recreate days_ago based on created_at
+        self.cur.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self.conn.commit()
+        
+        if version < 2:
+            # returns space freed by smaller records to the disk
+            printer.change_status("Compacting posts.db")
+            self.cur.execute('VACUUM')
+    
+    def convert_records(self):
+        # Rewrites pickled posts as records, one batch at a time
+        printer.change_status("Converting posts.db to new format")
+        old_cur = self.conn.cursor()
+        old_cur.execute('SELECT id, struct FROM post_data')
+        rows = old_cur.fetchmany(constants.MAX_RESULTS_OFFLINE)
+        while rows:
+            self.cur.executemany('UPDATE post_data SET struct = ? WHERE id = ?',
+                [ (records.encode_post(records.load_post(struct)), id) for id, struct in rows if not records.is_record(struct) ])
+            rows = old_cur.fetchmany(constants.MAX_RESULTS_OFFLINE)
+        old_cur.close()
+    
+    def _tags_condition(self, masks):
+        # posts that have any of masks
+        exact = [mask for mask in masks if '*' not in mask]
+        wildcards = [glob_escape(mask) for mask in masks if '*' in mask]
+        conditions = []
+        if exact:
+            conditions.append(f"tags.name IN ({','.join('?' * len(exact))})")
+        conditions += ['tags.name GLOB ?'] * len(wildcards)
+        
+        return (f"SELECT post_id FROM post_tags JOIN tags ON tags.id = post_tags.tag_id WHERE {' OR '.join(conditions)}",
+                exact + wildcards)
+    
+    def make_query(self, last_id, whitelist=None, blacklist=None, anylist=None, ratings=None,
+                   min_score=None, min_favs=None, days_ago=None, has_actual_search=True, **dummy):
+        # Only narrows the search, every post is still
+        # checked by process_result after that.
+        # Metatags are not indexed, so they are left for process_result.
+        conditions = ['id <= ?']
+        params = [last_id]
+        
+        for mask in (whitelist.masks if whitelist else []):
+            if ':' not in mask:
+                condition, condition_params = self._tags_condition([mask])
+                conditions.append(f'id IN ({condition})')
+                params += condition_params
+        
+        blacklisted = [mask for mask in (blacklist.masks if blacklist else []) if ':' not in mask]
+        if blacklisted:
+            condition, condition_params = self._tags_condition(blacklisted)
+            conditions.append(f'id NOT IN ({condition})')
+            params += condition_params
+        
+        if anylist and not any(':' in mask for mask in anylist.masks):
+            condition, condition_params = self._tags_condition(anylist.masks)
+            conditions.append(f'id IN ({condition})')
+            params += condition_params
+        
+        if ratings is not None:
+            conditions.append(f"rating IN ({','.join('?' * len(ratings))})")
+            params += list(ratings)
+        
+        if min_score is not None:
+            conditions.append('score >= ?')
+            params.append(min_score)
+        
+        if min_favs is not None:
+            conditions.append('fav_count >= ?')
+            params.append(min_favs)
+        
+        if days_ago is not None:
+            conditions.append('created_at > ?')
+            params.append(int(time() - days_ago * 86400))
+        
+        return f"SELECT struct FROM post_data WHERE {' AND '.join(conditions)} ORDER BY id DESC", params
+    
+    def gen(self, last_id, **filters):
+        self.cur.execute(*self.make_query(last_id, **filters))
+        results=[records.load_post(result[0]) for result in self.cur.fetchmany()]
         while results:
             yield results
-            results=[pickle.loads(result[0]) for result in self.cur.fetchmany()]
+            results=[records.load_post(result[0]) for result in self.cur.fetchmany()]
+
+class TagCache:
+    # Tags and aliases checked in previous runs, in tags.db.
+    # actual is the name a config tag resolves to:
+    # the tag itself, or consequent of an alias.
+    def __init__(self, ttl_days = constants.TAG_CACHE_DAYS, refresh = False):
+        self.conn = None
+        self.configure(ttl_days, refresh)
+    
+    def configure(self, ttl_days = None, refresh = None):
+        if ttl_days is not None:
+            self.ttl = ttl_days * 24 * 60 * 60
+        if refresh is not None:
+            self.refresh = refresh
+    
+    def connect(self):
+        if self.conn:
+            return
+        self.conn = storage.connect('tags.db')
+        self.cur = self.conn.cursor()
+        self.cur.executescript(
+            '''CREATE TABLE IF NOT EXISTS tag_cache (
+                name        TEXT PRIMARY KEY
+                                NOT NULL,
+                actual      TEXT NOT NULL,
+                post_count  INTEGER,
+                checked_at  REAL NOT NULL
+            ) WITHOUT ROWID;'''
+        )
+    
+    def get_many(self, names):
+        # {name: actual} of entries younger than ttl
+        if self.refresh or self.ttl <= 0:
+            return {}
+        
+        self.connect()
+        oldest = time() - self.ttl
+        result = {}
+        for chunk in chunks(names, constants.SQLITE_MAX_VARIABLES - 1):
+            self.cur.execute(f'''SELECT name, actual FROM tag_cache
+                WHERE checked_at >= ? AND name IN ({','.join('?'*len(chunk))})''', (oldest, *chunk))
+            result.update(self.cur.fetchall())
+        return result
+    
+    def put_many(self, rows, checked_at = None):
+        # rows are (name, actual, post_count)
+        if self.ttl <= 0:
+            return
+        
+        self.connect()
+        checked_at = checked_at or time()
+        rows = [ (name, actual, post_count, checked_at) for name, actual, post_count in rows ]
+        storage.writer.call('tags.db', lambda cur: cur.executemany('INSERT OR REPLACE INTO tag_cache VALUES (?,?,?,?)', rows))
+    
+    @staticmethod
+    def is_alias_export(filename):
+        with open(filename, newline='', encoding='utf-8') as infile:
+            return 'antecedent_name' in (csv.DictReader(infile).fieldnames or [])
+    
+    def import_csv(self, filename):
+        # e621 db export, tags-<date>.csv or tag_aliases-<date>.csv.
+        # Entries are as old as the export file.
+        checked_at = os.path.getmtime(filename)
+        with open(filename, newline='', encoding='utf-8') as infile:
+            reader = csv.DictReader(infile)
+            if 'antecedent_name' in (reader.fieldnames or []):
+                rows = ( (row['antecedent_name'], row['consequent_name'], None) for row in reader
+                         if row.get('status', 'active').lower() in {'active', 'approved'} )
+            else:
+                rows = ( (row['name'], row['name'], int(row['post_count'] or 0)) for row in reader )
+            
+            count = 0
+            while True:
+                chunk = list(islice(rows, 10000))
+                if not chunk:
+                    break
+                self.put_many(chunk, checked_at)
+                count += len(chunk)
+        return count
+    
+tag_cache = TagCache()
 
 class PathesStorage:
+    # Paths are collected between begin and commit,
+    # then storage writer saves them in one batch
     def __init__(self):
-        self.conn = sqlite3.connect('files.db', isolation_level=None)
+        create_files_tables()
+        self.conn = storage.connect('files.db')
         self.cur = self.conn.cursor()
+        self._pending = []
+        self.begin()
     
     def begin(self):
-        self.cur.execute("BEGIN;")        
+        self._new_files = []
+        self._downloaded = []
+        self._created = []
     
     def add_pathes(self, directories, filename):
-        #self.cur.execute("BEGIN TRANSACTION;")
-        for directory in directories:
-            filepath = self.make_path(directory, filename)
-            self.cur.execute('INSERT OR REPLACE INTO new_files VALUES (?);', (filepath,))
+        self._new_files += [ (self.make_path(directory, filename),) for directory in directories ]
     
     def add_all_time_downloaded(self, directories, filename):
-        for directory in directories:
-            filepath = self.make_path(directory, filename)
-            self.cur.execute('INSERT OR REPLACE INTO downloaded VALUES (?);', (filepath,))
+        self._downloaded += [ (self.make_path(directory, filename),) for directory in directories ]
+    
+    def add_files(self, pathes):
+        # files just created by the downloader
+        self._created += pathes
     
     def commit(self):
-        self.cur.execute("COMMIT;")
+        new_files, downloaded, created = self._new_files, self._downloaded, self._created
+        self.begin()
+        if not (new_files or downloaded or created):
+            return
+        
+        def write(cur):
+            cur.executemany('INSERT OR REPLACE INTO new_files VALUES (?)', new_files)
+            cur.executemany('INSERT OR REPLACE INTO downloaded VALUES (?)', downloaded)
+            FileIndex(cur).add(created)
+        self._pending.append(storage.writer.submit('files.db', write))
+    
+    def sync(self):
+        # everything committed so far is in files.db after this
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
     
     @lru_cache(maxsize=None, typed=False)
     def make_new_dir(self, dir_name):
@@ -353,13 +979,18 @@ class PathesStorage:
         return f"downloads/{self.make_new_dir(dir_name)}/{substitute_illegals_filename(filename)}"
 
     def remove_old(self):
+        self.commit()
+        self.sync()
         self.cur.execute('''
             SELECT fullpath FROM old_files
             EXCEPT
             SELECT fullpath FROM new_files;''')
-        for (filename, ) in self.cur:
+        removed = [filename for (filename, ) in self.cur.fetchall()]
+        for filename in removed:
             with suppress(FileNotFoundError):
                 os.remove(filename)
+        
+        storage.writer.call('files.db', lambda cur: FileIndex(cur).remove(removed))
 
 _handler_gc_protection = [] #in case of lambdas
 
@@ -417,6 +1048,57 @@ def save_on_exit_events(close_handler):
     _handler_gc_protection.append(close_handler)
     atexit.register(close_handler)
 
+class PostTags:
+    # Tags of one post, prepared once for every TagMatcher.
+    # count is used to notice tags appended after, e.g. pool:<id>
+    __slots__ = ('set', 'count', '_text')
+    def __init__(self, tags):
+        self.set = frozenset(tags)
+        self.count = len(tags)
+        self._text = None
+    
+    @property
+    def text(self):
+        # one tag per line, for wildcard regular expressions
+        if self._text is None:
+            self._text = '\n'.join(self.set)
+        return self._text
+
+def mask_to_regex(mask):
+    return re.escape(mask).replace('\\*','.*')
+
+class TagMatcher:
+    # Tags without '*' are looked up in a set of post tags,
+    # masks with '*' are joined into one regular expression
+    # that runs once over all tags of a post.
+    def __init__(self, masks):
+        self.masks = list(masks)
+        self.exact = frozenset(mask for mask in self.masks if '*' not in mask)
+        self.wildcards = [mask for mask in self.masks if '*' in mask]
+        
+        # for "all of" every mask has to be checked separately
+        self._wildcard_regs = [re.compile(f'^{mask_to_regex(mask)}$', re.M) for mask in self.wildcards]
+        if self.wildcards:
+            self._any_reg = re.compile('^(?:' + '|'.join(mask_to_regex(mask) for mask in self.wildcards) + ')$', re.M)
+        else:
+            self._any_reg = None
+    
+    def __bool__(self):
+        return bool(self.masks)
+    
+    def __len__(self):
+        return len(self.masks)
+    
+    def all(self, post_tags):
+        if not self.exact <= post_tags.set:
+            return False
+        return all(reg.search(post_tags.text) for reg in self._wildcard_regs)
+    
+    def any(self, post_tags):
+        if not self.exact.isdisjoint(post_tags.set):
+            return True
+        return self._any_reg is not None and self._any_reg.search(post_tags.text) is not None
+
 def _check(tag, tags):
     return tag in tags
 
@@ -583,187 +1265,435 @@ def make_cache_folder():
         pass
     
 IMAGE_MATCH =  re.compile(r".*?(\d+?)\.(?:jpg|png|gif|swf|webm)$")
+
+def progress_path(path):
+    return f"{path}.{constants.PROGRESS_EXT}"
+
+def partial_offset(path):
+    # How much of partial download is actually downloaded.
+    # Preallocated file is bigger than that, so if there is a progress
+    # file left by interrupted run, file is cut to what it says.
+    size = os.path.getsize(path)
+    try:
+        with open(progress_path(path)) as progress:
+            offset = min(int(progress.read()), size)
+    except FileNotFoundError:
+        return size
+    except ValueError:
+        offset = 0
+    
+    with open(path, 'r+b') as partial:
+        partial.truncate(offset)
+    os.remove(progress_path(path))
+    return offset
+
+def remove_partial(path):
+    with suppress(FileNotFoundError):
+        os.remove(path)
+    with suppress(FileNotFoundError):
+        os.remove(progress_path(path))
+    with suppress(FileNotFoundError):
+        os.remove(SegmentState.state_path(path))
+
+def preallocate(fd, offset, length):
+    if length > 0 and hasattr(os, 'posix_fallocate'):
+        with suppress(OSError):
+            os.posix_fallocate(fd, offset, length)
+            return True
+    return False
+
+class SegmentState:
+    # Byte ranges of a segmented download and how much of each range
+    # is already written, as [start, end, done]. Kept in <file>.segments,
+    # so interrupted download continues only missing parts.
+    def __init__(self, path, size = None, count = None):
+        self.path = path
+        self._lock = Lock()
+        self._saved = time()
+        try:
+            with open(self.state_path(path)) as state:
+                data = json.load(state)
+            self.size = data['size']
+            self.segments = data['segments']
+        except (FileNotFoundError, ValueError, KeyError):
+            if not size:
+                raise
+            step = -(-size // count)
+            self.size = size
+            self.segments = [[start, min(start + step, size), 0] for start in range(0, size, step)]
+            self.save()
+    
+    @staticmethod
+    def state_path(path):
+        return f"{path}.{constants.SEGMENTS_EXT}"
+    
+    @classmethod
+    def exists(cls, path):
+        return os.path.isfile(cls.state_path(path))
+    
+    def missing(self):
+        with self._lock:
+            return [index for index, (start, end, done) in enumerate(self.segments) if start + done < end]
+    
+    def remaining(self, index):
+        with self._lock:
+            start, end, done = self.segments[index]
+            return start + done, end
+    
+    def advance(self, index, length):
+        with self._lock:
+            self.segments[index][2] += length
+            if time() - self._saved > constants.PROGRESS_SAVE_INTERVAL:
+                self._save()
+    
+    def _save(self):
+        with atomic_write(self.state_path(self.path), overwrite=True) as state:
+            json.dump({'size': self.size, 'segments': self.segments}, state)
+        self._saved = time()
+    
+    def save(self):
+        with self._lock:
+            self._save()
+    
+    def remove(self):
+        with suppress(FileNotFoundError):
+            os.remove(self.state_path(self.path))
+
+class WriteBehindFile:
+    # Partial download written by its own thread, so network reads
+    # don't wait for disk. Buffers are reused once written.
+    # While file is open it is preallocated to its full size, so
+    # written size is kept in a progress file in case of a crash.
+    def __init__(self, path, offset, total_size = None, hasher = None):
+        self.path = path
+        self.offset = offset
+        self.hasher = hasher
+        
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        os.ftruncate(self._fd, offset)
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        
+        # Progress file goes first: file may be left full size
+        # by a kill right after preallocation
+        self._preallocated = bool(total_size) and total_size > offset
+        if self._preallocated:
+            self._save_progress()
+            self._preallocated = preallocate(self._fd, offset, total_size - offset)
+            if not self._preallocated:
+                with suppress(FileNotFoundError):
+                    os.remove(progress_path(path))
+        
+        self._free = deque()
+        self._queue = Queue(maxsize = constants.WRITE_BEHIND_BUFFERS)
+        self._error = None
+        self._progress_saved = time()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def get_buffer(self, size):
+        while self._free:
+            buffer = self._free.popleft()
+            if len(buffer) == size:
+                return buffer
+        return bytearray(size)
+    
+    def write(self, buffer, length):
+        if self._error:
+            raise self._error
+        self._queue.put( (buffer, length) )
+    
+    def _save_progress(self):
+        if not self._preallocated:
+            return
+        with atomic_write(progress_path(self.path), overwrite=True) as progress:
+            progress.write(str(self.offset))
+        self._progress_saved = time()
+    
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            
+            buffer, length = item
+            if self._error is None:
+                try:
+                    view = memoryview(buffer)[:length]
+                    if self.hasher:
+                        self.hasher.update(view)
+                    while view:
+                        view = view[os.write(self._fd, view):]
+                    self.offset += length
+                    if time() - self._progress_saved > constants.PROGRESS_SAVE_INTERVAL:
+                        self._save_progress()
+                except OSError as e:
+                    self._error = e
+            
+            if isinstance(buffer, bytearray):
+                self._free.append(buffer)
+    
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            # unused preallocated space
+            os.ftruncate(self._fd, self.offset)
+        finally:
+            os.close(self._fd)
+        with suppress(FileNotFoundError):
+            os.remove(progress_path(self.path))
+        if self._error:
+            raise self._error
+    
+    def __enter__(self):
+        return self
     
+    def __exit__(self, *args):
+        self.close()
+    
+def file_id(tree, file):
+    # id of a post the file belongs to, or None
+    if tree == 'cache':
+        try:
+            return int(file.split('.')[-2]) #id section
+        except (IndexError,ValueError):
+            return None
+    
+    match = IMAGE_MATCH.match(file)
+    if match:
+        return int(match[1])
+    return None
+
+class FileIndex:
+    # Files in cache/ and downloads/ with post ids, kept in files.db
+    # between runs. Directory is listed again only if its mtime changed
+    # since it was listed last time. Downloader adds every file it
+    # creates, so its own downloads don't make directory look changed.
+    # Works on a cursor of storage writer, inside of its transaction.
+    
+    # directories that were checked against disk during this run
+    validated = set()
+    
+    def __init__(self, cur):
+        self.cur = cur
+    
+    @staticmethod
+    def _key(directory):
+        return directory.replace('\\','/').rstrip('/')
+    
+    @staticmethod
+    def fullpath(path):
+        # directories are lowercase, file names are kept as they are,
+        # same as new downloads get from PathesStorage.make_path
+        path = path.replace('\\','/')
+        return '{}/{}'.format(FileIndex._key(os.path.dirname(path)).lower(), os.path.basename(path))
+    
+    def _forget_tree(self, directory):
+        key = self._key(directory)
+        prefix = key + '/'
+        self.cur.execute('DELETE FROM file_index WHERE directory = ? OR substr(directory, 1, ?) = ?', (key, len(prefix), prefix))
+        self.cur.execute('DELETE FROM dir_index WHERE directory = ? OR substr(directory, 1, ?) = ?', (key, len(prefix), prefix))
+    
+    def refresh(self, root):
+        tree = root.strip('/\\')
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            key = self._key(directory)
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                self._forget_tree(directory)
+                continue
+            
+            self.cur.execute('SELECT mtime, subdirs FROM dir_index WHERE directory = ?', (key,))
+            row = self.cur.fetchone()
+            if row and row[0] == mtime:
+                subdirs = row[1].split('/') if row[1] else []
+            else:
+                subdirs = []
+                rows = []
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        else:
+                            id = file_id(tree, entry.name)
+                            if id is not None:
+                                filepath='{}/{}'.format(key.lower(), entry.name)
+                                rows.append( (filepath, key, tree, id) )
+                
+                if row:
+                    old_subdirs = set(row[1].split('/')) if row[1] else set()
+                    for gone in old_subdirs - set(subdirs):
+                        self._forget_tree(os.path.join(directory, gone))
+                
+                self.cur.execute('DELETE FROM file_index WHERE directory = ?', (key,))
+                self.cur.executemany('INSERT OR REPLACE INTO file_index VALUES (?,?,?,?)', rows)
+                self.cur.execute('INSERT OR REPLACE INTO dir_index VALUES (?,?,?)', (key, mtime, '/'.join(subdirs)))
+            
+            FileIndex.validated.add(key)
+            stack.extend(os.path.join(directory, subdir) for subdir in subdirs)
+    
+    def rebuild(self):
+        # next refresh lists every directory again
+        self.cur.execute('DELETE FROM dir_index')
+        self.cur.execute('DELETE FROM file_index')
+    
+    def add(self, pathes):
+        directories = set()
+        rows = []
+        for path in pathes:
+            path = path.replace('\\','/')
+            tree = path.split('/')[0]
+            directory = self._key(os.path.dirname(path))
+            id = file_id(tree, os.path.basename(path))
+            if id is not None:
+                rows.append( (self.fullpath(path), directory, tree, id) )
+            directories.add(directory)
+        self.cur.executemany('INSERT OR REPLACE INTO file_index VALUES (?,?,?,?)', rows)
+        
+        # Listing of a directory that was up to date
+        # at start is still up to date with our own files
+        mtimes = []
+        for directory in directories & FileIndex.validated:
+            with suppress(FileNotFoundError):
+                mtimes.append( (os.stat(directory).st_mtime_ns, directory) )
+        self.cur.executemany('UPDATE dir_index SET mtime = ? WHERE directory = ?', mtimes)
+    
+    def remove(self, pathes):
+        self.cur.executemany('DELETE FROM file_index WHERE fullpath = ?', ( (self.fullpath(path),) for path in pathes ) )
+    
+    def ids(self, tree):
+        self.cur.execute('SELECT id, fullpath FROM file_index WHERE tree = ?', (tree,))
+        return self.cur.fetchall()
+    
+FILES_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS old_files (
+        fullpath    TEXT PRIMARY KEY
+                       UNIQUE
+                       NOT NULL
+    ) WITHOUT ROWID;
+    
+    CREATE TABLE IF NOT EXISTS new_files (
+        fullpath    TEXT PRIMARY KEY
+                       UNIQUE
+                       NOT NULL
+    ) WITHOUT ROWID;
+    
+    CREATE TABLE IF NOT EXISTS downloaded (
+        fullpath    TEXT PRIMARY KEY
+                       UNIQUE
+                       NOT NULL
+    );
+    
+    CREATE TABLE IF NOT EXISTS file_index (
+        fullpath    TEXT PRIMARY KEY
+                       NOT NULL,
+        directory   TEXT NOT NULL,
+        tree        TEXT NOT NULL,
+        id          INTEGER
+    ) WITHOUT ROWID;
+    
+    CREATE INDEX IF NOT EXISTS file_index_directory ON file_index (directory);
+    CREATE INDEX IF NOT EXISTS file_index_tree_id ON file_index (tree, id);
+    
+    CREATE TABLE IF NOT EXISTS dir_index (
+        directory   TEXT PRIMARY KEY
+                       NOT NULL,
+        mtime       INTEGER NOT NULL,
+        subdirs     TEXT NOT NULL
+    ) WITHOUT ROWID;
+    '''
+
+def create_files_tables():
+    storage.writer.script('files.db', FILES_SCHEMA)
+
 def get_all_time_downloaded():
-    conn = sqlite3.connect('files.db', isolation_level=None)
+    create_files_tables()
+    conn = storage.connect('files.db')
     cur = conn.cursor()
     
     cur.execute('''
         SELECT fullpath FROM downloaded;''')
         
-    # deleting them
     result = set()
     for (fullpath, ) in cur:
         result.add(fullpath)
+    conn.close()
     return result
     
-def get_files_dict(reset_filedb, reset_all_time_downloaded):
-    #args = [arg.strip().lower() for arg in sys.argv]
-    filedict={}
-
-    for root, dirs, files in os.walk('cache/'):
-        for file in files:
-            try:
-                id=file.split('.')[-2] #id section
-                id=int(id)
-                filepath='{}/{}'.format(root.replace('\\','/').lower(),file)
-                filedict[id]=filepath
-            except (IndexError,ValueError):
-                pass
-                    
-    conn = sqlite3.connect('files.db', isolation_level=None)
-    cur = conn.cursor()
-
-    cur.executescript(
-        '''
-        BEGIN TRANSACTION;
-        
-        CREATE TABLE IF NOT EXISTS old_files (
-            fullpath    TEXT PRIMARY KEY
-                           UNIQUE
-                           NOT NULL
-        ) WITHOUT ROWID;
-        
-        CREATE TABLE IF NOT EXISTS new_files (
-            fullpath    TEXT PRIMARY KEY
-                           UNIQUE
-                           NOT NULL
-        ) WITHOUT ROWID;
-        
-        CREATE TABLE IF NOT EXISTS downloaded (
-            fullpath    TEXT PRIMARY KEY
-                           UNIQUE
-                           NOT NULL
-        );
-        
-        COMMIT;
-        '''
-    )
-
-
-    if reset_filedb:
-        cur.executescript(
-            '''
-            BEGIN TRANSACTION;
-            
-            DELETE FROM old_files;
-            DELETE FROM new_files;
-            
-            COMMIT;
-            '''
-        )
+def get_files_dict(reset_filedb, reset_all_time_downloaded, rebuild_index = False):
+    create_files_tables()
     
-    if reset_all_time_downloaded:
-        cur.executescript(
-            '''
-            BEGIN TRANSACTION;
-
-            DELETE FROM downloaded;
-            
-            COMMIT;
-            '''
-        )
+    def update(cur):
+        file_index = FileIndex(cur)
+        if rebuild_index:
+            file_index.rebuild()
+        file_index.refresh('cache/')
+        file_index.refresh('downloads/')
+        
+        if reset_filedb:
+            cur.execute('DELETE FROM old_files')
+            cur.execute('DELETE FROM new_files')
+            cur.execute("INSERT INTO old_files SELECT fullpath FROM file_index WHERE tree = 'downloads'")
+        
+        if reset_all_time_downloaded:
+            cur.execute('DELETE FROM downloaded')
+        
+        return file_index.ids('downloads'), file_index.ids('cache')
     
-    conn.commit()
-    cur.execute("BEGIN TRANSACTION;")
-    for root, dirs, files in os.walk('downloads/'):
-        for file in files:
-            match = IMAGE_MATCH.match(file)
-            if match:
-                id=int(match[1])
-                filepath='{}/{}'.format(root.replace('\\','/').lower(),file)
-                if id not in filedict:
-                    filedict[id]=filepath
-                if reset_filedb:
-                    cur.execute('INSERT INTO old_files VALUES (?);', (filepath,))
-    cur.execute("COMMIT;")
-    conn.commit()
+    downloads, cache = storage.writer.call('files.db', update)
+    
+    # files from cache have priority
+    filedict={}
+    for id, filepath in downloads:
+        filedict.setdefault(id, filepath)
+    for id, filepath in cache:
+        filedict[id] = filepath
     
     return filedict
 
 
 def append_files(filedict, pathes):
-    conn = sqlite3.connect('files.db', isolation_level=None)
-    cur = conn.cursor()
-    cur.execute("BEGIN TRANSACTION;")
+    rows = []
     for path in pathes:
-        file=os.path.basename(newpath)
+        file=os.path.basename(path)
         match = IMAGE_MATCH.match(file)
         if match:
             id=int(match[1])
-            filepath=path.replace('\\','/').lower()
+            filepath=FileIndex.fullpath(path)
             filedict[id]=filepath
-            cur.execute('INSERT INTO old_files VALUES (?);', (filepath,))
-    cur.execute("COMMIT;")
-    conn.commit()
+            rows.append( (filepath,) )
+    
+    def write(cur):
+        FileIndex(cur).add(pathes)
+        cur.executemany('INSERT OR IGNORE INTO old_files VALUES (?)', rows)
+    storage.writer.call('files.db', write)
 
 def prune_cache():
-    conn = sqlite3.connect('files.db', isolation_level=None)
-    cur = conn.cursor()
-    cur.executescript(
-        '''
-        BEGIN TRANSACTION;
-        DROP TABLE IF EXISTS used_ids;
-        
-        CREATE TABLE used_ids (
-            id    INTEGER PRIMARY KEY
-                           UNIQUE
-                           NOT NULL
-        ) WITHOUT ROWID;
-
-        DROP TABLE IF EXISTS cached_files;
-        
-        CREATE TABLE cached_files (
-            id    INTEGER PRIMARY KEY
-                           UNIQUE
-                           NOT NULL,
-            fullpath       TEXT 
-                           UNIQUE
-                           NOT NULL   
-        ) WITHOUT ROWID;
-        
-        COMMIT;
-        '''
-    )
-    
-    # making a list of all files that are in "downloads/"
-    conn.commit()
-    cur.execute("BEGIN TRANSACTION;")
-    for root, dirs, files in os.walk('downloads/'):
-        for file in files:
-            match = IMAGE_MATCH.match(file)
-            if match:
-                id=int(match[1])
-                cur.execute('INSERT OR IGNORE INTO used_ids VALUES (?);', (id,))
-    cur.execute("COMMIT;")
-    conn.commit()
+    def unused(cur):
+        file_index = FileIndex(cur)
+        file_index.refresh('cache/')
+        file_index.refresh('downloads/')
+        
+        # finding files that are in cache but not in downloads
+        cur.execute('''
+            SELECT cached.fullpath FROM file_index AS cached
+            WHERE cached.tree = 'cache'
+            AND NOT EXISTS (SELECT 1 FROM file_index AS used
+                            WHERE used.tree = 'downloads' AND used.id = cached.id);''')
+        return [filename for (filename, ) in cur.fetchall()]
     
-    # making a list of all files that are in "cache/"
-    cur.execute("BEGIN TRANSACTION;")
-    for root, dirs, files in os.walk('cache/'):
-        for file in files:
-            try:
-                id=file.split('.')[-2] #id section
-                id=int(id)
-                filepath='{}/{}'.format(root.replace('\\','/').lower(),file)
-                cur.execute('INSERT INTO cached_files VALUES (?,?);', (id,filepath))
-            except (IndexError, ValueError):
-                pass
-    cur.execute("COMMIT;")
-    conn.commit()
-    
-    # finding files that are in cache but not in downloads
-    cur.execute('''
-        SELECT fullpath FROM cached_files
-        LEFT JOIN used_ids
-        ON used_ids.id = cached_files.id
-        WHERE used_ids.id IS NULL;''')
+    removed = storage.writer.call('files.db', unused)
         
     # deleting them
-    for (filename, ) in cur:
+    for filename in removed:
         with suppress(FileNotFoundError):
             os.remove(filename)
     
+    storage.writer.call('files.db', lambda cur: FileIndex(cur).remove(removed))
+    
 def validate_format(format):
     post = {i:i for i in constants.DEFAULT_SLOTS}
     try:
@@ -842,19 +1772,42 @@ def get_cookies():
     
     return f"__cfduid={__cfduid}; cf_clearance={cf_clearance};"
 
+# Folders of pools, like download queue: additions go to pools.journal,
+# whole dict to pools.pickle only when journal gets big
+pools_journal = Journal('pools.journal')
+
 def reset_pools():
+    pools_journal.restart(0)
     if os.path.exists("pools.pickle"):
         os.remove("pools.pickle")
         
 def load_pools():
-    if not os.path.exists("pools.pickle"):
-        return {}
-    with open('pools.pickle', 'rb') as f:
-        return pickle.load(f)
+    pools = {}
+    generation = 0
+    if os.path.exists("pools.pickle"):
+        with open('pools.pickle', 'rb') as f:
+            state = pickle.load(f)
+        # older versions saved just the dict
+        if isinstance(state, dict):
+            pools = state
+        else:
+            generation, pools = state
+    for pool, folders in pools_journal.read(generation):
+        pools.setdefault(pool, []).extend(folders)
+    return pools
+
+def add_pool_folders(pools, pool, folders):
+    pools.setdefault(pool, []).extend(folders)
+    pools_journal.append((pool, folders))
         
 def save_pools(pools):
-    with atomic_write('pools.pickle', mode='wb', overwrite=True) as f:
-        pickle.dump(pools, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if pools_journal.size > constants.JOURNAL_COMPACT_SIZE:
+        generation = pools_journal.generation + 1
+        with atomic_write('pools.pickle', mode='wb', overwrite=True) as f:
+            pickle.dump((generation, pools), f, protocol=pickle.HIGHEST_PROTOCOL)
+        pools_journal.restart(generation)
+    else:
+        pools_journal.sync()
         
 # https://stackoverflow.com/a/312464/3921746
 def chunks(lst, n):
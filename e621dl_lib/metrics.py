@@ -0,0 +1,206 @@
+# Internal Imports
+import json
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Thread, Lock, Event
+from time import perf_counter, time
+
+# External Imports
+from atomicwrites import atomic_write
+
+# Personal Imports
+from . import constants
+
+# Timings and totals of every stage of a run, so a slow run can be
+# told apart: rate limit sleep, API latency, parsing, filtering,
+# disk or bandwidth. Nothing is recorded until metrics are enabled.
+#
+# Every value has a name and optional labels, e.g. section of a filter.
+# Histograms are cumulative like Prometheus ones, quantiles in JSON
+# summary are upper bounds of the bucket they fall in.
+
+PREFIX = 'e621dl_'
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'min', 'max')
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        needed = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= needed:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99)}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+def _bound_text(bound):
+    return repr(float(bound))
+
+class Metrics:
+    def __init__(self):
+        self._lock = Lock()
+        self.enabled = False
+        self._histograms = {}
+        self._totals = {}
+        self._gauges = {}
+        self._started = time()
+        self._stop = Event()
+        self._thread = None
+        self.interval = constants.METRICS_INTERVAL
+        self.json_file = constants.METRICS_JSON_FILE
+        self.prometheus_file = constants.METRICS_PROMETHEUS_FILE
+
+    def configure(self, enabled, interval = constants.METRICS_INTERVAL):
+        self.enabled = enabled
+        self.interval = interval
+
+    def observe(self, name, value, buckets = constants.METRICS_TIME_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def add(self, name, value = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._totals[key] = self._totals.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def summary(self):
+        with self._lock:
+            histograms = {key: histogram.summary() for key, histogram in self._histograms.items()}
+            totals = dict(self._totals)
+            gauges = dict(self._gauges)
+
+        def grouped(values):
+            result = {}
+            for (name, labels), value in sorted(values.items()):
+                entry = dict(value) if isinstance(value, dict) else {'value': value}
+                entry['labels'] = dict(labels)
+                result.setdefault(name, []).append(entry)
+            return result
+
+        return {'started': datetime.fromtimestamp(self._started).isoformat(timespec = 'seconds'),
+                'seconds': time() - self._started,
+                'histograms': grouped(histograms),
+                'totals': grouped(totals),
+                'gauges': grouped(gauges)}
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._totals.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {PREFIX}{name} counter")
+                lines.append(f"{PREFIX}{name}{_label_text(labels)} {value}")
+
+            for (name, labels), value in sorted(self._gauges.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {PREFIX}{name} gauge")
+                lines.append(f"{PREFIX}{name}{_label_text(labels)} {value}")
+
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {PREFIX}{name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{PREFIX}{name}_bucket{_label_text(labels + (('le', _bound_text(bound)),))} {cumulative}")
+                lines.append(f"{PREFIX}{name}_bucket{_label_text(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{PREFIX}{name}_sum{_label_text(labels)} {histogram.sum}")
+                lines.append(f"{PREFIX}{name}_count{_label_text(labels)} {histogram.count}")
+
+        lines.append(f"# TYPE {PREFIX}uptime_seconds gauge")
+        lines.append(f"{PREFIX}uptime_seconds {time() - self._started}")
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self):
+        with atomic_write(self.json_file, mode = 'w', overwrite = True) as outfile:
+            json.dump(self.summary(), outfile, indent = 2)
+
+    def write_prometheus(self):
+        with atomic_write(self.prometheus_file, mode = 'w', overwrite = True) as outfile:
+            outfile.write(self.prometheus_text())
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        self._stop.clear()
+        self._thread = Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self.enabled:
+                self.write_prometheus()
+
+    def stop(self):
+        # called on every exit, normal or not
+        if not self.enabled:
+            return
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.write_prometheus()
+        self.write_json()
+
+metrics = Metrics()
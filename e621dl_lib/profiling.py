@@ -0,0 +1,127 @@
+# Internal Imports
+import cProfile
+import io
+import os
+import pstats
+import tracemalloc
+from datetime import datetime
+from functools import wraps
+from threading import Lock, local
+
+# Personal Imports
+from . import constants
+
+# cProfile only sees the thread it was enabled in, so every thread
+# of a config run gets its own profile: API thread, download loop and
+# every download worker. Profiles of one role are merged in the report.
+#
+# Python 3.12+ allows only one active profiler at a time,
+# there only the first thread to ask is profiled.
+
+class Profiler:
+    def __init__(self):
+        self._lock = Lock()
+        self._local = local()
+        self.enabled = False
+        self.trace_memory = False
+        self._profiles = []
+        self._skipped = 0
+        self._name = None
+        self._start_snapshot = None
+
+    def configure(self, enabled, trace_memory = False):
+        self.enabled = enabled or trace_memory
+        self.trace_memory = trace_memory
+
+    def begin(self, config_name):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._profiles = []
+            self._skipped = 0
+            self._name = os.path.splitext(os.path.basename(config_name))[0]
+        self._local = local()
+        if self.trace_memory:
+            tracemalloc.start(constants.TRACEMALLOC_FRAMES)
+            self._start_snapshot = tracemalloc.take_snapshot()
+
+    def enable(self, role):
+        if not self.enabled or self._name is None:
+            return
+        profiles = getattr(self._local, 'profiles', None)
+        if profiles is None:
+            profiles = self._local.profiles = {}
+        profile = profiles.get(role)
+        if profile is None:
+            profile = profiles[role] = cProfile.Profile()
+            with self._lock:
+                self._profiles.append((role, profile))
+        try:
+            profile.enable()
+        except ValueError:
+            # another thread already profiles
+            with self._lock:
+                self._skipped += 1
+
+    def disable(self, role):
+        profile = getattr(self._local, 'profiles', {}).get(role)
+        if profile is not None:
+            profile.disable()
+
+    def wrap(self, function, role):
+        if not self.enabled:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            self.enable(role)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.disable(role)
+        return wrapper
+
+    def end(self):
+        if not self.enabled or self._name is None:
+            return
+        folder = f"{constants.PROFILES_DIR}/{self._name}_{datetime.now():%Y%m%d_%H%M%S}"
+        os.makedirs(folder, exist_ok=True)
+
+        with self._lock:
+            by_role = {}
+            for role, profile in self._profiles:
+                by_role.setdefault(role, []).append(profile)
+            skipped = self._skipped
+            self._profiles = []
+            self._name = None
+
+        # before reports, so they don't show up in allocations
+        if self.trace_memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(f"{folder}/memory.txt", 'w', encoding='utf-8') as outfile:
+                outfile.write(f"traced now: {current / 1024 / 1024:.1f} MiB, peak: {peak / 1024 / 1024:.1f} MiB\n\n")
+                outfile.write("Top allocations:\n")
+                for stat in snapshot.statistics('lineno')[:constants.PROFILE_TOP_ALLOCATIONS]:
+                    outfile.write(f"{stat}\n")
+                outfile.write("\nGrown since config start:\n")
+                for stat in snapshot.compare_to(self._start_snapshot, 'lineno')[:constants.PROFILE_TOP_ALLOCATIONS]:
+                    outfile.write(f"{stat}\n")
+            self._start_snapshot = None
+
+        for role, profiles in by_role.items():
+            profiles = [profile for profile in profiles if profile.getstats()]
+            if not profiles:
+                continue
+            text = io.StringIO()
+            text.write(f"{role}: {len(profiles)} thread(s)\n")
+            if skipped:
+                text.write(f"{skipped} thread(s) were not profiled, another profiler was active\n")
+            stats = pstats.Stats(*profiles, stream=text)
+            stats.dump_stats(f"{folder}/{role}.pstats")
+            stats.sort_stats('cumulative').print_stats(constants.PROFILE_TOP_FUNCTIONS)
+            with open(f"{folder}/{role}.txt", 'w', encoding='utf-8') as outfile:
+                outfile.write(text.getvalue())
+
+profiler = Profiler()
@@ -0,0 +1,128 @@
+# Internal Imports
+import struct
+import zlib
+import pickle
+
+# Personal Imports
+from . import constants
+
+# Compact binary form of remote.Post, used by posts.db and download queue.
+#
+# byte 0      - record version
+# byte 1      - flags, RECORD_ZLIB if the rest is compressed
+# rest        - integer fields as int64, then byte lengths of text fields
+#               as uint32, then all text fields as one UTF-8 blob
+#
+# Fields go in constants.DEFAULT_SLOTS order. Fields that can be
+# derived from others (tags, artist, created_at, days_ago) are not stored,
+# except for tags that are not in tag_ex, like metatags of a search.
+# Pickled posts start with 0x80, so they are never confused with a record.
+
+RECORD_VERSION = 1
+RECORD_ZLIB = 1
+PICKLE_PREFIX = 0x80
+
+NONE_INT = -2**63
+
+_INT_FIELDS = {'id', 'score', 'fav_count', 'file_size', 'width', 'height',
+               'creator_id', 'score_up', 'score_down'}
+_TEXT_FIELDS = {'rating', 'md5', 'file_ext', 'file_url', 'sources',
+                'description', 'created_at_string', 'tag_ex', 'pools'}
+
+INT_FIELDS = [name for name in constants.DEFAULT_SLOTS if name in _INT_FIELDS]
+TEXT_FIELDS = [name for name in constants.DEFAULT_SLOTS if name in _TEXT_FIELDS] + ['extra_tags']
+
+_header = struct.Struct('<BB')
+_body = struct.Struct(f'<{len(INT_FIELDS)}q{len(TEXT_FIELDS)}I')
+
+def pack_tag_ex(tag_ex):
+    # one line per category: "category tag tag tag"
+    return '\n'.join(' '.join([category] + taglist) for category, taglist in tag_ex.items())
+
+def unpack_tag_ex(text):
+    tag_ex = {}
+    if not text:
+        return tag_ex
+    for line in text.split('\n'):
+        category, *taglist = line.split(' ')
+        tag_ex[category] = taglist
+    return tag_ex
+
+def _text_value(post, name, flat_count):
+    if name == 'tag_ex':
+        return pack_tag_ex(post.tag_ex)
+    elif name == 'extra_tags':
+        return ' '.join(post.tags[flat_count:])
+    elif name == 'sources':
+        return '\n'.join(post.sources or [])
+    elif name == 'pools':
+        return ' '.join(str(pool) for pool in (post.pools or []))
+    else:
+        value = getattr(post, name)
+        return '' if value is None else value
+
+def encode_post(post, compress = constants.RECORD_COMPRESS):
+    flat_count = sum(len(taglist) for taglist in post.tag_ex.values())
+    ints = [NONE_INT if getattr(post, name) is None else int(getattr(post, name)) for name in INT_FIELDS]
+    texts = [_text_value(post, name, flat_count).encode('utf-8') for name in TEXT_FIELDS]
+    payload = _body.pack(*ints, *(len(text) for text in texts)) + b''.join(texts)
+
+    flags = 0
+    if compress and len(payload) > constants.RECORD_COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= RECORD_ZLIB
+
+    return _header.pack(RECORD_VERSION, flags) + payload
+
+def decode_post(record):
+    from .remote import Post
+
+    version, flags = _header.unpack_from(record)
+    if version != RECORD_VERSION:
+        raise ValueError(f"Unknown post record version {version}")
+
+    payload = record[_header.size:]
+    if flags & RECORD_ZLIB:
+        payload = zlib.decompress(payload)
+
+    values = _body.unpack_from(payload)
+    ints = values[:len(INT_FIELDS)]
+    lengths = values[len(INT_FIELDS):]
+
+    post = Post.__new__(Post)
+    for name, value in zip(INT_FIELDS, ints):
+        setattr(post, name, None if value == NONE_INT else value)
+
+    position = _body.size
+    texts = {}
+    for name, length in zip(TEXT_FIELDS, lengths):
+        texts[name] = payload[position:position+length].decode('utf-8')
+        position += length
+
+    post.tag_ex = unpack_tag_ex(texts.pop('tag_ex'))
+    extra_tags = texts.pop('extra_tags')
+    sources = texts.pop('sources')
+    pools = texts.pop('pools')
+    post.sources = sources.split('\n') if sources else []
+    post.pools = [int(pool) for pool in pools.split(' ')] if pools else []
+    for name, value in texts.items():
+        setattr(post, name, value)
+
+    post.tags = []
+    for taglist in post.tag_ex.values():
+        post.tags += taglist
+    if extra_tags:
+        post.tags += extra_tags.split(' ')
+    # artist and created_at are left for Post to derive when needed
+    return post
+
+def load_post(blob):
+    # posts.db and download queue from older versions have pickled posts
+    if blob[0] == PICKLE_PREFIX:
+        return pickle.loads(blob)
+    return decode_post(blob)
+
+def is_record(blob):
+    return blob[0] != PICKLE_PREFIX
@@ -1,9 +1,11 @@
 # Internal Imports
 import os
 import sys
-from time import sleep, time
+import hashlib
+from time import sleep, monotonic, time
 from datetime import datetime
-from functools import lru_cache
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 import sqlite3
 import pickle
 import re
@@ -13,64 +15,150 @@ import json
 
 # Personal Imports
 from . import constants
-from .local import printer
+from . import records
+from .metrics import metrics
+from .local import printer, download_set, PostTags, WriteBehindFile, SegmentState, partial_offset, remove_partial, preallocate, chunks, tag_cache
 
 # Vendor Imports
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from requests.exceptions import ConnectionError, ReadTimeout, HTTPError, MissingSchema
+from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 TIMEOUT = constants.CONNECTION_TIMEOUT
 
+class RateLimiter:
+    # Token bucket shared by every thread that talks to e621 API.
+    # Tokens can go below zero: a caller reserves its slot under the lock
+    # and sleeps outside of it, so concurrent callers queue up fairly.
+    def __init__(self, rate = constants.API_RATE_LIMIT, burst = constants.API_BURST):
+        self._lock = Lock()
+        self._rate = float(rate)
+        self._burst = int(burst)
+        self._tokens = float(burst)
+        self._last = monotonic()
+        self.waited = 0.0
+        self.requests = 0
+
+    def configure(self, rate = None, burst = None):
+        with self._lock:
+            if rate is not None:
+                if float(rate) <= 0:
+                    raise ValueError(f"api rate must be positive, got {rate}")
+                self._rate = float(rate)
+            if burst is not None:
+                self._burst = max(1, int(burst))
+                self._tokens = min(self._tokens, self._burst)
+
+    def acquire(self):
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+            self.waited += wait
+            self.requests += 1
+            waited, requests = self.waited, self.requests
+
+        metrics.observe('rate_limit_wait_seconds', wait)
+        if wait > 0:
+            printer.change_rate_wait(f"{waited:.1f}s over {requests} requests")
+            sleep(wait)
+        return wait
+
+api_limiter = RateLimiter()
+
+def _flat_tags(post):
+    tags = []
+    for dummy_cat, taglist in post.tag_ex.items():
+        tags += taglist
+    return tags + post._metatags
+
+def _created_at(post):
+    # datetime.fromisoformat('2020-03-06T13:47:53.354-05:00')
+    created_at_datetime = datetime.fromisoformat(post.created_at_string)
+    created_at_timestamp = created_at_datetime.timestamp()
+    created_at_timestamp_tz = created_at_datetime.tzname()
+    created_at_timestamp_s = int(created_at_timestamp)
+    created_at_timestamp_n = (created_at_timestamp - created_at_timestamp_s) * 1000_000_000
+    
+    return {'s': int(created_at_timestamp),
+            'n': created_at_timestamp_n,
+            'tz': created_at_timestamp_tz,
+            }
+
+# How to get every field from decoded API json of a post
+_LAZY_FIELDS = {
+    'created_at_string': lambda post: post._raw["created_at"],
+    'created_at': _created_at,
+    'tag_ex': lambda post: post._raw["tags"],
+    'tags': _flat_tags,
+    'rating': lambda post: post._raw["rating"],
+    'md5': lambda post: post._raw["file"]["md5"],
+    'file_ext': lambda post: post._raw["file"]["ext"],
+    'file_url': lambda post: post._raw["file"]["url"],
+    'file_size': lambda post: post._raw["file"]["size"],
+    'width': lambda post: post._raw["file"]["width"],
+    'height': lambda post: post._raw["file"]["height"],
+    'score': lambda post: post._raw["score"]["total"],
+    'score_up': lambda post: post._raw["score"]["up"],
+    'score_down': lambda post: post._raw["score"]["down"],
+    'fav_count': lambda post: post._raw["fav_count"],
+    'sources': lambda post: post._raw["sources"],
+    'artist': lambda post: '_'.join(post.tag_ex["artist"]),
+    'description': lambda post: post._raw["description"],
+    'pools': lambda post: post._raw["pools"],
+    'creator_id': lambda post: post._raw["uploader_id"],
+}
+
 class Post:
-    __slots__ = constants.DEFAULT_SLOTS
+    # Most posts are thrown away by filters right after they are parsed,
+    # so fields are taken from the json only when something asks for them,
+    # and then kept in slots. days_ago is not a slot, it is
+    # counted from created_at every time, so it's never stale.
+    __slots__ = [name for name in constants.DEFAULT_SLOTS if name != 'days_ago'] + ['_raw', '_metatags', '_post_tags']
     def __init__(self, post, metatags):
+        self._raw = post
+        self._metatags = metatags
         self.id=post["id"]
-        # datetime.fromisoformat('2020-03-06T13:47:53.354-05:00')
-        created_at_datetime = datetime.fromisoformat(post["created_at"])
-        created_at_timestamp = created_at_datetime.timestamp()
-        created_at_timestamp_tz = created_at_datetime.tzname()
-        created_at_timestamp_s = int(created_at_timestamp)
-        created_at_timestamp_n = (created_at_timestamp - created_at_timestamp_s) * 1000_000_000
-        
-        self.days_ago=int(datetime.now().timestamp()-created_at_timestamp)/86400 # day have 3600*24==86400 seconds
-        self.created_at= {'s': int(created_at_timestamp),
-                          'n': created_at_timestamp_n,
-                          'tz': created_at_timestamp_tz,
-                          }
-                          
-        self.created_at_string = post["created_at"]
-        self.tag_ex = post["tags"]
-        self.tags = []
-        for dummy_cat, taglist in self.tag_ex.items():
-            self.tags += taglist
-        self.tags += metatags
-        
-        self.rating = post["rating"]
-        
-        file = post["file"]
-        self.md5 = file["md5"]
-        self.file_ext = file["ext"]
-        self.file_url = file["url"]
-        self.file_size = file["size"]
-        self.width = file["width"]
-        self.height = file["height"]
-        
-        score = post["score"]
-        self.score = score["total"]
-        self.score_up = score["up"]
-        self.score_down = score["down"]
+    
+    def __getattr__(self, name):
+        # only called if slot is not set yet
+        if name == 'days_ago':
+            return int(time() - self.created_at['s'])/86400 # day have 3600*24==86400 seconds
         
-        self.fav_count = post["fav_count"]
-        self.sources = post["sources"]
-        self.artist = '_'.join(self.tag_ex["artist"])
-        self.description = post["description"]
-        self.pools = post["pools"]
-        self.creator_id = post["uploader_id"]
+        loader = _LAZY_FIELDS.get(name)
+        if loader is None:
+            raise AttributeError(f"'Post' object has no attribute '{name}'")
         
+        value = loader(self)
+        setattr(self, name, value)
+        return value
+    
     def generate(self):
-        return {name:getattr(self,name,'Unknown') for name in self.__slots__}
+        return {name:getattr(self,name,'Unknown') for name in constants.DEFAULT_SLOTS}
+    
+    def post_tags(self):
+        # Shared by every search that checks this post.
+        # Recreated if some tags were appended since.
+        post_tags = getattr(self, '_post_tags', None)
+        if post_tags is None or post_tags.count != len(self.tags):
+            post_tags = PostTags(self.tags)
+            self._post_tags = post_tags
+        return post_tags
+    
+    def __reduce__(self):
+        # pickled as a compact record, e.g. in download queue
+        return records.decode_post, (records.encode_post(self),)
+    
+    def __setstate__(self, state):
+        # Posts pickled by older versions, with days_ago slot and such
+        dummy_dict_state, slots_state = state
+        for name, value in (slots_state or {}).items():
+            if name in Post.__slots__:
+                setattr(self, name, value)
 
 def make_posts_list(json_list, metatags):
     post_list=[]
@@ -84,6 +172,7 @@ def requests_retry_session(
     backoff_factor = 0.3,
     status_forcelist = (500, 502, 504),
     session = None,
+    pool_maxsize = constants.DOWNLOAD_THREADS,
 ):
     session = session or requests.Session()
     retry = Retry(
@@ -94,30 +183,41 @@ def requests_retry_session(
         status_forcelist = status_forcelist,
         method_whitelist = frozenset(['GET', 'POST'])
     )
-    adapter = HTTPAdapter(max_retries = retry)
+    # every download thread plus API thread needs its own connection,
+    # and segmented download takes a few more
+    adapter = HTTPAdapter(max_retries = retry, pool_maxsize = pool_maxsize + constants.DOWNLOAD_SEGMENTS + 2)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 
-def retrying_get(s, *args, **kwargs):
+# Every attempt, retries included, takes a token from limiter if one is given.
+# File downloads are not subject to API rate limit, so they pass no limiter.
+def limited_call(method, limiter, *args, **kwargs):
+    if not limiter:
+        return method(*args, **kwargs)
+    limiter.acquire()
+    with metrics.timer('api_request_seconds'):
+        return method(*args, **kwargs)
+
+def retrying_get(s, *args, limiter = None, **kwargs):
     for i in range(1,100):
         try:
-            return s.get(*args, **kwargs)
+            return limited_call(s.get, limiter, *args, **kwargs)
         except (ConnectionError, ReadTimeout):
             printer.increment_retries()
-            
-    return s.get(*args, **kwargs)
     
+    return limited_call(s.get, limiter, *args, **kwargs)
     
-def retrying_post(s, *args, **kwargs):
+    
+def retrying_post(s, *args, limiter = None, **kwargs):
     for i in range(1,100):
         try:
-            return s.post(*args, **kwargs)
+            return limited_call(s.post, limiter, *args, **kwargs)
         except (ConnectionError, ReadTimeout):
             printer.increment_retries()
-            
-    return s.post(*args, **kwargs)
+    
+    return limited_call(s.post, limiter, *args, **kwargs)
 
 def check_cloudflare(response):
     if response.status_code != 403:
@@ -164,19 +264,11 @@ def ask_cookies():
     sys.exit(0)
     
 def delayed_post(url, payload, session):
-    # Take time before and after getting the requests response.
-    start = time()
+    # One request per second rule is enforced by api_limiter
     if payload:
-        response = retrying_post(session, url, data = payload, timeout=TIMEOUT)
+        response = retrying_post(session, url, data = payload, timeout=TIMEOUT, limiter=api_limiter)
     else:
-        response = retrying_post(session, url, timeout=TIMEOUT)
-    elapsed = time() - start
-
-    # Citation from e621:api
-    # "You should make a best effort not to make 
-    # more than one request per second over a sustained period."
-    if elapsed < 1.0:
-        sleep(1.0 - elapsed)
+        response = retrying_post(session, url, timeout=TIMEOUT, limiter=api_limiter)
 
     if check_cloudflare(response):
         ask_cookies()
@@ -186,19 +278,11 @@ def delayed_post(url, payload, session):
 
 
 def delayed_get(url, payload, session):
-    # Take time before and after getting the requests response.
-    start = time()
+    # One request per second rule is enforced by api_limiter
     if payload:
-        response = retrying_get(session, url, data = payload, timeout=TIMEOUT)
+        response = retrying_get(session, url, data = payload, timeout=TIMEOUT, limiter=api_limiter)
     else:
-        response = retrying_get(session, url, timeout=TIMEOUT)
-    elapsed = time() - start
-
-    # Citation from e621:api
-    # "You should make a best effort not to make 
-    # more than one request per second over a sustained period."
-    if elapsed < 1.0:
-        sleep(1.0 - elapsed)
+        response = retrying_get(session, url, timeout=TIMEOUT, limiter=api_limiter)
 
     if check_cloudflare(response):
         ask_cookies()
@@ -214,11 +298,21 @@ def get_github_release(session):
 
     return response.json()['tag_name'].strip('v')
 
-def get_posts(last_id, search_tags, earliest_date, session, api_key, login, **dummy):
+def id_range(below, above):
+    # ids between two known ones, both excluded
+    if below and above:
+        return f"id:{above+1}..{below-1}"
+    elif below:
+        return f"id:<{below}"
+    elif above:
+        return f"id:>{above}"
+    return ''
+
+def get_posts(last_id, search_tags, earliest_date, session, api_key, login, watermark = None, **dummy):
  
     metatags =[tag for tag in search_tags if ':' in tag and tag[0] not in '~-' and '*' not in tag]
     search_string = ' '.join(search_tags)
-    url = 'https://e621.net/posts.json'
+    url = f'{constants.API_BASE_URL}/posts.json'
     
     reordered = False
     
@@ -236,29 +330,25 @@ def get_posts(last_id, search_tags, earliest_date, session, api_key, login, **du
             'limit': constants.MAX_RESULTS,
         }
         if last_id in (0x7F_FF_FF_FF, None):
-            payload["tags"] = tags
-        else:
-            payload["tags"] = f"id:<{last_id} {tags}"
+            last_id = None
+        payload["tags"] = f"{id_range(last_id, watermark)} {tags}".strip()
 
     if api_key and login:
         payload["login"] = login
         payload["api_key"] = api_key
 
     while True:
-        start = time()
-        response = retrying_get(session, url, data=payload, timeout=TIMEOUT)
+        response = retrying_get(session, url, data=payload, timeout=TIMEOUT, limiter=api_limiter)
 
         while check_cloudflare(response):
             solve_captcha(session, response)
-            elapsed = time() - start
-            if elapsed < 1.0:
-                sleep(1.0 - elapsed)
-            response = retrying_get(session, url, data=payload, timeout=TIMEOUT)
+            response = retrying_get(session, url, data=payload, timeout=TIMEOUT, limiter=api_limiter)
         
         response.raise_for_status()
 
-        posts_orig = response.json()["posts"]
-        results=make_posts_list(posts_orig, metatags)
+        with metrics.timer('parse_seconds'):
+            posts_orig = response.json()["posts"]
+            results=make_posts_list(posts_orig, metatags)
         
  
         if results:
@@ -272,110 +362,254 @@ def get_posts(last_id, search_tags, earliest_date, session, api_key, login, **du
                 break
         else:
             last_id = posts_orig[-1]["id"]
-            payload["tags"] = f"id:<{last_id} {tags}"
+            payload["tags"] = f"{id_range(last_id, watermark)} {tags}".strip()
+
+def get_known_files(post_ids, api_key, login, session):
+    # {id: file info} for many posts with one request per PARTIALS_PER_REQUEST ids,
+    # and set of ids that were actually checked: a failed request
+    # says nothing about posts of its batch
+    url = f'{constants.API_BASE_URL}/posts.json'
+    result = {}
+    checked = set()
+    for ids in chunks(post_ids, constants.PARTIALS_PER_REQUEST):
+        payload = {'limit': constants.MAX_RESULTS,
+                   'tags': f"id:{','.join(str(id) for id in ids)} status:any"}
+        if api_key and login:
+            payload["login"] = login
+            payload["api_key"] = api_key
         
-        elapsed = time() - start
-        if elapsed < 1.0:
-            sleep(1.0 - elapsed)
-
-def get_known_post(post_id, api_key, login, session):
-    url = f'https://e621.net/posts/{post_id}.json'
-
-    if api_key and login:
-        response = delayed_get(url, {'login':login, 'api_key': api_key}, session)
-    else:
-        response = delayed_get(url, None, session)
-    response.raise_for_status()
-
-    return response.json()["post"]
-
-@lru_cache(maxsize=None, typed=False)
-def get_tag_alias(user_tag, api_key, login, session):
-    prefix = ''
+        try:
+            response = delayed_get(url, payload, session)
+            if response is None:
+                continue
+            response.raise_for_status()
+            posts = response.json()["posts"]
+        except (HTTPError, ValueError, KeyError):
+            continue
+        
+        for post in posts:
+            result[post['id']] = post['file']
+        checked.update(ids)
+    return result, checked
+
+# tag from config -> its actual name, None if there is no such tag or alias
+tag_aliases = {}
+
+def prefetch_tag_aliases(user_tags, api_key, login, session):
+    # Checks many tags with a few requests: names first,
+    # then aliases for names that are not tags.
+    names = {tag.lstrip('~-') for tag in user_tags}
+    names = sorted(name for name in names if name and ':' not in name and '*' not in name and name not in tag_aliases)
+    if not names:
+        return
+    
+    tag_aliases.update(tag_cache.get_many(names))
+    names = [name for name in names if name not in tag_aliases]
+    if not names:
+        return
+    
+    checked = []
+    auth = {'login':login, 'api_key': api_key} if api_key and login else {}
     
-    if user_tag[0] == '~':
-        prefix = '~'
-        user_tag = user_tag[1:]
-        return prefix+get_tag_alias(user_tag, api_key, login, session)
+    for chunk in chunks(names, constants.TAGS_PER_REQUEST):
+        printer.change_tag(f"{len(chunk)} tags starting with {chunk[0]}")
+        payload = {'search[name]': ','.join(chunk), 'limit': constants.MAX_RESULTS, **auth}
+        response = delayed_get(f'{constants.API_BASE_URL}/tags.json', payload, session)
+        if response is None:
+            continue
+        response.raise_for_status()
+        
+        results = response.json()
+        # nothing found is {"tags": []}
+        if isinstance(results, list):
+            for tag in results:
+                tag_aliases[tag['name']] = tag['name']
+                checked.append( (tag['name'], tag['name'], tag.get('post_count')) )
+    
+    missing = [name for name in names if name not in tag_aliases]
+    for chunk in chunks(missing, constants.TAGS_PER_REQUEST):
+        payload = {'search[antecedent_name]': ','.join(chunk), 'limit': constants.MAX_RESULTS, **auth}
+        response = delayed_get(f'{constants.API_BASE_URL}/tag_aliases.json', payload, session)
+        if response is None:
+            continue
+        response.raise_for_status()
+        
+        results = response.json()
+        if isinstance(results, list):
+            for alias in results:
+                if alias.get('status', 'active').lower() in {'active', 'approved'}:
+                    tag_aliases[alias['antecedent_name']] = alias['consequent_name']
+                    checked.append( (alias['antecedent_name'], alias['consequent_name'], None) )
+    
+    # tags that do not exist are not cached, they may be created any time
+    tag_cache.put_many(checked)
+    for name in missing:
+        tag_aliases.setdefault(name, None)
 
-    if user_tag[0] == '-':
-        prefix = '-'
-        user_tag = user_tag[1:]
-        return prefix+get_tag_alias(user_tag, api_key, login, session)
+def get_tag_alias(user_tag, api_key, login, session):
+    if user_tag[0] in '~-':
+        return user_tag[0]+get_tag_alias(user_tag[1:], api_key, login, session)
 
     if ':' in user_tag:
         printer.change_warning(f"Impossible to check if {user_tag} is valid.")
-        return user_tag    
+        return user_tag
+    
+    if '*' in user_tag:
+        if user_tag not in tag_aliases:
+            tag_aliases[user_tag] = user_tag if has_tags_matching(user_tag, api_key, login, session) else None
+    elif user_tag not in tag_aliases:
+        prefetch_tag_aliases([user_tag], api_key, login, session)
+    
+    actual_tag = tag_aliases.get(user_tag)
+    if actual_tag is None:
+        printer.show(False)
+        print(f"[!] The tag {user_tag} is spelled incorrectly or does not exist.")
+        raise SystemExit
+    
+    if actual_tag == user_tag:
+        printer.change_tag(f"{user_tag} is valid.")
+    else:
+        printer.change_tag(f"{user_tag} was changed to {actual_tag}.")
+    return actual_tag
 
-    url = 'https://e621.net/tags.json'
+def has_tags_matching(mask, api_key, login, session):
+    url = f'{constants.API_BASE_URL}/tags.json'
     if api_key and login:
-        payload = {'search[name_matches]': user_tag, 'login':login, 'api_key': api_key}
+        payload = {'search[name_matches]': mask, 'login':login, 'api_key': api_key}
     else:
-        payload = {'search[name_matches]': user_tag}
+        payload = {'search[name_matches]': mask}
         
     response = delayed_get(url, payload, session)
     response.raise_for_status()
 
     results = response.json()
-
-    #if at least one tag was found for tag with "*"
-    if '*' in user_tag:
-        if results:
-            printer.change_tag(f"{user_tag} is valid.")
-            return user_tag
-        else:
-            printer.show(False)
-            print(f"[!] The tag {prefix}{user_tag} is spelled incorrectly or does not exist.")
-            raise SystemExit
-            return ''
+    return bool(results) and not ("tags" in results and not results["tags"])
+
+def md5_of_file(path, hasher = None):
+    hasher = hasher or hashlib.md5()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(constants.HASH_READ_SIZE), b''):
+            hasher.update(chunk)
+    return hasher
+
+def quarantine(path):
+    os.makedirs(constants.QUARANTINE_DIR, exist_ok = True)
+    basename = os.path.basename(path).replace(f".{constants.PARTIAL_DOWNLOAD_EXT}", '')
+    newpath = os.path.join(constants.QUARANTINE_DIR, basename)
+    os.replace(path, newpath)
+    return newpath
+
+def read_into(raw, buffer):
+    # same translation of urllib3 errors as requests does in iter_content
+    try:
+        return raw.readinto(buffer)
+    except ProtocolError as e:
+        raise ConnectionError(e)
+    except ReadTimeoutError as e:
+        raise ReadTimeout(e)
+
+def adapt_chunk_size(chunk_size, length, elapsed):
+    # bigger reads while they arrive fast, smaller ones on a slow connection
+    if length == chunk_size and elapsed < constants.DOWNLOAD_CHUNK_TIME / 2:
+        return min(chunk_size * 2, constants.DOWNLOAD_CHUNK_MAX)
+    elif elapsed > constants.DOWNLOAD_CHUNK_TIME * 2:
+        return max(chunk_size // 2, constants.DOWNLOAD_CHUNK_MIN)
+    return chunk_size
+
+def write_response(response, writer):
+    downloaded_bytes = 0
     
-    if not ("tags" in results and not results["tags"]):
-        for tag in results:
-            if user_tag == tag['name']:
-                printer.change_tag(f"{prefix}{user_tag} is valid.")
-                return f"{prefix}{user_tag}"
-
-
-    # At this point, we found no tag 
-    # and we are starting to search aliases
+    # raw stream of compressed response is still compressed
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        for chunk in response.iter_content(chunk_size = constants.DOWNLOAD_CHUNK_MIN):
+            writer.write(chunk, len(chunk))
+            downloaded_bytes += len(chunk)
+        return downloaded_bytes
     
-    pagenum = 1
-    def alias_chunk():
-        url = 'https://e621.net/tag_aliases.json'
-        if api_key and login:
-            payload = {'search[status]': 'Approved', 'search[name_matches]': user_tag, 'page': pagenum, 'login':login, 'api_key': api_key}
-        else:
-            payload = {'search[status]': 'Approved', 'search[name_matches]': user_tag, 'page': pagenum}
-        response = delayed_get(url, payload, session)
-        response.raise_for_status()
-
-        results = response.json()
-        return results
-
-    results = alias_chunk()
-    while results:
-        if ("tag_aliases" in results and not results["tag_aliases"]):
-            break;
-            
-        for tag in results:
-            if user_tag == tag['antecedent_name']:
-
-                actual_tag = tag["consequent_name"]
-                printer.change_tag(f"{prefix}{user_tag} was changed to {prefix}{actual_tag}.")
-
-                return f"{prefix}{actual_tag}"
-        
-        pagenum += 1
-        if pagenum >= 750:
+    chunk_size = constants.DOWNLOAD_CHUNK_MIN
+    while True:
+        buffer = writer.get_buffer(chunk_size)
+        start = monotonic()
+        length = read_into(response.raw, buffer)
+        if not length:
             break
-        results = alias_chunk()
+        writer.write(buffer, length)
+        downloaded_bytes += length
+        chunk_size = adapt_chunk_size(chunk_size, length, monotonic() - start)
+    
+    response.raw.release_conn()
+    return downloaded_bytes
 
-    printer.show(False)
-    print(f"[!] The tag {prefix}{user_tag} is spelled incorrectly or does not exist.")
-    raise SystemExit
-    return ''
+def download_segment(url, path, session, state, index, request_kwargs):
+    # False if server ignores Range
+    start, end = state.remaining(index)
+    if start >= end:
+        return True
+    
+    header = {'Range': f"bytes={start}-{end-1}"}
+    response = retrying_get(session, url, stream = True, headers = header, timeout=TIMEOUT, **request_kwargs)
+    if response.status_code in (429, 503):
+        download_set.report_error()
+    if response.status_code != 206:
+        response.close()
+        return False
+    
+    buffer = bytearray(constants.DOWNLOAD_CHUNK_MAX)
+    fd = os.open(path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        os.lseek(fd, start, os.SEEK_SET)
+        while start < end:
+            length = read_into(response.raw, memoryview(buffer)[:min(len(buffer), end - start)])
+            if not length:
+                raise ConnectionError(f"segment of {url} ended at {start} instead of {end}")
+            view = memoryview(buffer)[:length]
+            while view:
+                view = view[os.write(fd, view):]
+            start += length
+            state.advance(index, length)
+    finally:
+        os.close(fd)
+    
+    response.raw.release_conn()
+    return True
+
+def download_segmented(url, path, session, state, request_kwargs):
+    # Every missing segment is fetched by its own thread straight into its place in file.
+    # False if server does not support ranges.
+    def segment_worker(index):
+        for i in range(1,100):
+            try:
+                return download_segment(url, path, session, state, index, request_kwargs)
+            except (ConnectionError, ReadTimeout):
+                printer.increment_retries()
+                download_set.report_error()
+        return download_segment(url, path, session, state, index, request_kwargs)
+    
+    with open(path, 'r+b') as partial:
+        if os.path.getsize(path) < state.size:
+            partial.truncate(state.size)
+            preallocate(partial.fileno(), 0, state.size)
+    
+    missing = state.missing()
+    try:
+        with ThreadPoolExecutor(max_workers = len(missing) or 1) as pool:
+            results = list(pool.map(segment_worker, missing))
+    finally:
+        state.save()
+    
+    if all(results):
+        state.remove()
+        return True
+    return False
 
-def download_post(url, path, session, cachefunc, duplicate_func, api_key, login):
+def report_download(nbytes, seconds):
+    download_set.report_download(nbytes, seconds)
+    metrics.add('download_bytes_total', nbytes)
+    metrics.observe('download_seconds', seconds)
+    if seconds > 0:
+        metrics.observe('download_bytes_per_second', nbytes / seconds, constants.METRICS_RATE_BUCKETS)
+
+def download_post(url, path, session, cachefunc, duplicate_func, api_key, login, md5 = None, md5_mismatch = constants.MD5_MISMATCH, file_size = None):
     if f".{constants.PARTIAL_DOWNLOAD_EXT}" not in path:
         path += f".{constants.PARTIAL_DOWNLOAD_EXT}"
 
@@ -385,48 +619,136 @@ def download_post(url, path, session, cachefunc, duplicate_func, api_key, login)
             pass
     except FileExistsError:
         pass
-
+    
+    newpath=path.replace(f".{constants.PARTIAL_DOWNLOAD_EXT}", '')
+    request_kwargs = {'data': {'login':login, 'api_key': api_key}} if api_key and login else {}
+    
+    segmented = SegmentState.exists(path) or \
+        (file_size or 0) >= constants.SEGMENTED_MIN_SIZE and os.path.getsize(path) == 0
+    
+    # md5 of everything written to partial file so far.
+    # Prefix left by previous run is read once, the rest is hashed while streaming.
+    hasher = None
+    if not segmented:
+        partial_offset(path)
+        if md5:
+            hasher = md5_of_file(path)
+    
+    def finish():
+        os.rename(path, newpath)
+        printer.change_file(newpath)
+        if cachefunc:
+            basename=os.path.basename(newpath)
+            cachepath='.'.join(basename.split('.')[-2:])
+            try:
+                duplicate_func(newpath, f"cache/{cachepath}")
+            except FileExistsError:
+                os.remove(newpath)
+                duplicate_func(f"cache/{cachepath}", newpath)
+        return True
+    
+    def verified():
+        if not md5 or hasher.hexdigest() == md5.lower():
+            return True
+        
+        printer.increment_md5_mismatches()
+        if md5_mismatch == 'keep':
+            printer.change_warning(f"md5 mismatch, kept anyway: {newpath}")
+            return True
+        
+        return False
+    
+    def segmented_download():
+        nonlocal hasher, segmented
+        try:
+            state = SegmentState(path, file_size, constants.DOWNLOAD_SEGMENTS)
+        except (FileNotFoundError, ValueError, KeyError):
+            # unreadable state and no size to start over with
+            state = None
+        
+        start = monotonic()
+        if state and download_segmented(url, path, session, state, request_kwargs):
+            report_download(state.size, monotonic() - start)
+            # segments arrive out of order, so file is hashed once when it's complete
+            if md5:
+                hasher = md5_of_file(path)
+            return verified()
+        
+        # no Range support, whole file in one stream
+        segmented = False
+        remove_partial(path)
+        open(path, 'wb').close()
+        hasher = hashlib.md5() if md5 else None
+        return attempt()
+    
     def stream_download():
-        header = {'Range': f"bytes={os.path.getsize(path)}-"}
-        if api_key and login:
-            response = retrying_get(session, url, stream = True, headers = header, data={'login':login, 'api_key': api_key}, timeout=TIMEOUT)
-        else:
-            response = retrying_get(session, url, stream = True, headers = header, timeout=TIMEOUT)
+        nonlocal hasher
+        offset = os.path.getsize(path)
+        header = {'Range': f"bytes={offset}-"}
+        start = monotonic()
+        response = retrying_get(session, url, stream = True, headers = header, timeout=TIMEOUT, **request_kwargs)
+        
+        if response.status_code in (429, 503):
+            download_set.report_error()
+        
+        # partial file from previous run was already complete
+        if response.status_code == 416 and md5 and offset > 0:
+            return verified()
+        
+        if response.ok:
+            # server ignored Range and sends whole file
+            if response.status_code != 206:
+                offset = 0
+                if md5:
+                    hasher = hashlib.md5()
             
-        if response.ok:    
-            with open(path, 'ab') as outfile:
-                for chunk in response.iter_content(chunk_size = 8192):
-                    outfile.write(chunk)
-            newpath=path.replace(f".{constants.PARTIAL_DOWNLOAD_EXT}", '')
-            os.rename(path, newpath)
-            printer.change_file(newpath)
-            if cachefunc:
-                basename=os.path.basename(newpath)
-                cachepath='.'.join(basename.split('.')[-2:])
-                try:
-                    duplicate_func(newpath, f"cache/{cachepath}")
-                except FileExistsError:
-                    os.remove(newpath)
-                    duplicate_func(f"cache/{cachepath}", newpath)
-                    
-                    
-            return True
+            total_size = file_size or offset + int(response.headers.get('Content-Length', 0))
+            with WriteBehindFile(path, offset, total_size, hasher) as writer:
+                downloaded_bytes = write_response(response, writer)
+            report_download(downloaded_bytes, monotonic() - start)
+            return verified()
 
         else:
-            os.remove(path)
-            return False
+            remove_partial(path)
+            return None
 
-    for i in range(1,100):
-        try:
-            return stream_download()
-        except (ConnectionError, ReadTimeout):
-            printer.increment_retries()
-            
-    return stream_download()
+    def attempt():
+        if segmented:
+            return segmented_download()
+        
+        for i in range(1,100):
+            try:
+                return stream_download()
+            except (ConnectionError, ReadTimeout):
+                printer.increment_retries()
+                download_set.report_error()
+        return stream_download()
     
+    for i in range(constants.MD5_RETRIES + 1):
+        result = attempt()
+        if result is None:
+            return False
+        if result:
+            return finish()
+        
+        if md5_mismatch == 'retry' and i < constants.MD5_RETRIES:
+            printer.change_warning(f"md5 mismatch, downloading again: {newpath}")
+            remove_partial(path)
+            open(path, 'wb').close()
+            hasher = hashlib.md5()
+        else:
+            break
     
-def finish_partial_downloads(session, cachefunc, duplicate_func, filedict, api_key, login):
-    downloaded_files = []
+    printer.change_warning(f"md5 mismatch, moved to {quarantine(path)}")
+    return False
+    
+    
+def finish_partial_downloads(session, cachefunc, duplicate_func, filedict, api_key, login, md5_mismatch = constants.MD5_MISMATCH, known_posts = None):
+    # known_posts are posts that were waiting for download when e621dl stopped,
+    # their partial downloads need no API request at all
+    known_posts = known_posts or {}
+    
+    partials = []
     for root, dirs, files in os.walk('downloads/'):
         for file in files:
             if file.endswith(constants.PARTIAL_DOWNLOAD_EXT):
@@ -435,27 +757,52 @@ def finish_partial_downloads(session, cachefunc, duplicate_func, filedict, api_k
                 newpath=path.replace(f".{constants.PARTIAL_DOWNLOAD_EXT}", '')
 
                 if os.path.exists(newpath):
-                    os.remove(path)
+                    remove_partial(path)
                     continue
                     
                 elif id in filedict:
-                    os.remove(path)
+                    remove_partial(path)
                     duplicate_func(filedict[id], newpath)
                     continue
                     
-                printer.change_warning(f" Partial download {file} found.")
-
-                try:
-                    url = get_known_post(id, api_key, login, session)['file']['url']
-                except (HTTPError, ValueError, MissingSchema):
-                    os.remove(path)
-                    continue
-                
-                try:
-                    if download_post(url, path, session, cachefunc, duplicate_func, api_key, login):
-                        downloaded_files.append(newpath)
-                except (HTTPError, ValueError, MissingSchema):
-                    os.remove(path)
-                    continue
-                    
-    return downloaded_files
\ No newline at end of file
+                partials.append( (id, path, newpath) )
+    
+    if not partials:
+        return []
+    
+    printer.change_warning(f" {len(partials)} partial downloads found.")
+    
+    file_infos = {}
+    for id, post in known_posts.items():
+        if post.file_url:
+            file_infos[id] = {'url': post.file_url, 'md5': post.md5, 'size': post.file_size}
+    
+    checked = set(file_infos)
+    unknown_ids = sorted({id for id, path, newpath in partials if id not in file_infos})
+    if unknown_ids:
+        found, checked_ids = get_known_files(unknown_ids, api_key, login, session)
+        file_infos.update(found)
+        checked |= checked_ids
+    
+    def finish_partial(id, path, newpath):
+        if id not in checked:
+            # kept for the next run
+            return None
+        file_info = file_infos.get(id)
+        if not file_info or not file_info['url']:
+            remove_partial(path)
+            return None
+        
+        with download_set.context_id(id):
+            try:
+                if download_post(file_info['url'], path, session, cachefunc, duplicate_func, api_key, login,
+                                 md5 = file_info['md5'], md5_mismatch = md5_mismatch, file_size = file_info['size']):
+                    return newpath
+            except (HTTPError, ValueError, MissingSchema):
+                remove_partial(path)
+        return None
+    
+    with ThreadPoolExecutor(max_workers = download_set.max_threads) as pool:
+        results = list(pool.map(lambda partial: finish_partial(*partial), partials))
+    
+    return [newpath for newpath in results if newpath]
@@ -0,0 +1,160 @@
+# Internal Imports
+import os
+import sqlite3
+from contextlib import suppress
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread, RLock
+
+# Personal Imports
+from . import constants
+from .metrics import metrics
+
+# posts.db, files.db and tags.db are in WAL mode, so reading
+# never waits for writing and a commit is one append to the -wal file.
+# Everything is written by the one writer thread: other threads
+# submit jobs, functions of a cursor, and get futures back.
+# Jobs that piled up while writer was busy share one transaction
+# per database, each job in a savepoint, so a failed job undoes
+# only its own changes.
+
+def connect(path, **kwargs):
+    conn = sqlite3.connect(path, timeout = constants.SQLITE_BUSY_TIMEOUT, **kwargs)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA synchronous = {constants.SQLITE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA mmap_size = {constants.SQLITE_MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size = {-(constants.SQLITE_CACHE_SIZE // 1024)}') # negative is KiB
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+_FLUSH = object()
+_STOP = object()
+
+class Writer:
+    def __init__(self):
+        self._jobs = Queue(constants.SQLITE_WRITE_QUEUE)
+        # reentrant: close() runs from signal handler, maybe while
+        # the same thread is in submit() or flush()
+        self._lock = RLock()
+        self._thread = None
+
+    def submit(self, path, job, transaction = True):
+        # Result of the future is set when the job is committed.
+        # Jobs without transaction, e.g. executescript or VACUUM,
+        # run after everything before them is committed.
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target = self._run, daemon = True)
+                self._thread.start()
+        self._jobs.put( (os.path.abspath(path), job, transaction, future) )
+        return future
+
+    def call(self, path, job, transaction = True):
+        return self.submit(path, job, transaction).result()
+
+    def script(self, path, sql):
+        self.call(path, lambda cur: cur.executescript(sql), transaction = False)
+
+    def flush(self):
+        # everything submitted before is committed after this
+        with self._lock:
+            if self._thread is None:
+                return
+        future = Future()
+        self._jobs.put( (_FLUSH, None, False, future) )
+        future.result()
+
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._jobs.put( (_STOP, None, False, None) )
+        thread.join()
+
+    def _run(self):
+        connections = {}
+        stop = False
+        while not stop:
+            jobs = [self._jobs.get()]
+            while True:
+                try:
+                    jobs.append(self._jobs.get_nowait())
+                except Empty:
+                    break
+            metrics.observe('sqlite_batch_jobs', len(jobs), buckets = constants.METRICS_DEPTH_BUCKETS)
+
+            transactions = {}
+            for path, job, transaction, future in jobs:
+                if path is _STOP:
+                    stop = True
+                    continue
+                if path is _FLUSH:
+                    self._commit_all(connections, transactions)
+                    future.set_result(None)
+                    continue
+
+                try:
+                    conn = connections.get(path)
+                    if conn is None:
+                        conn = connections[path] = connect(path, isolation_level = None)
+                    if not transaction:
+                        self._commit(path, conn, transactions)
+                        future.set_result(self._execute(conn, job))
+                        continue
+                    if path not in transactions:
+                        conn.execute('BEGIN')
+                        transactions[path] = []
+                    conn.execute('SAVEPOINT job')
+                except BaseException as e:
+                    future.set_exception(e)
+                    continue
+
+                try:
+                    result = self._execute(conn, job)
+                except BaseException as e:
+                    # some errors roll back whole transaction themselves
+                    with suppress(sqlite3.Error):
+                        conn.execute('ROLLBACK TO job')
+                        conn.execute('RELEASE job')
+                    future.set_exception(e)
+                else:
+                    conn.execute('RELEASE job')
+                    transactions[path].append( (future, result) )
+
+            self._commit_all(connections, transactions)
+
+        for conn in connections.values():
+            conn.close()
+
+    @staticmethod
+    def _execute(conn, job):
+        cur = conn.cursor()
+        try:
+            return job(cur)
+        finally:
+            cur.close()
+
+    def _commit_all(self, connections, transactions):
+        for path in list(transactions):
+            self._commit(path, connections[path], transactions)
+
+    @staticmethod
+    def _commit(path, conn, transactions):
+        done = transactions.pop(path, None)
+        if done is None:
+            return
+        try:
+            with metrics.timer('sqlite_commit_seconds', db = os.path.splitext(os.path.basename(path))[0]):
+                conn.execute('COMMIT')
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for future, result in done:
+                future.set_exception(e)
+            return
+        for future, result in done:
+            future.set_result(result)
+
+writer = Writer()